@@ -1,12 +1,14 @@
-def associate_paragraphs_with_elements(elements):
-    """Associate paragraphs with their nearest preceding visual element"""
+import numpy as np
+from element_store import PARAGRAPH, ElementStore
+
+def iter_associated_elements(elements):
+    """Lazily associate paragraphs with their nearest preceding visual element"""
     current_visual = None
-    processed_elements = []
     
     for element in elements:
         if element['type'] in ['figure_table', 'equation'] and element['file_path']:
             current_visual = element
-            processed_elements.append(element)
+            yield element
         elif element['type'] == 'paragraph':
             if current_visual:
                 element['associated_element'] = {
@@ -14,6 +16,22 @@ def associate_paragraphs_with_elements(elements):
                     'title': current_visual.get('title', ''),
                     'file_path': current_visual['file_path']
                 }
-            processed_elements.append(element)
-    
-    return processed_elements 
\ No newline at end of file
+            yield element
+
+def associate_store(store):
+    """ElementStore version of iter_associated_elements, vectorized over the rows"""
+    rows = np.arange(len(store))
+    is_visual = (store.types != PARAGRAPH) & np.array([bool(path) for path in store.file_paths], dtype=bool)
+    # Row of the latest visual at or before each row, -1 before the first one
+    latest_visual = np.maximum.accumulate(np.where(is_visual, rows, -1)) if len(store) else rows
+    is_paragraph = store.types == PARAGRAPH
+    store.associated = np.where(is_paragraph & (latest_visual >= 0), latest_visual, store.associated).astype(np.int32)
+    # Visuals without a file are dropped, like in the streaming version
+    return store.take(np.flatnonzero(is_visual | is_paragraph))
+
+def associate_paragraphs_with_elements(elements):
+    """Associate paragraphs with their nearest preceding visual element.
+    Accepts a list of elements or an ElementStore (returned as a store)"""
+    if isinstance(elements, ElementStore):
+        return associate_store(elements)
+    return list(iter_associated_elements(elements))
@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+
+STAGES = ('parse', 'figures', 'equations')
+# Modules used as a library, and the dependencies they may only load on first use
+LIBRARY_MODULES = ('element_store', 'stage_cache', 'metrics', 'pdf_pages', 'ocr_cache', 'parse_textbook',
+                   'pdfFigureExtract', 'equationExtract', 'validate_elements', 'associate_content', 'context_index',
+                   'page_index', 'create_scenes', 'openai_resources', 'fill_scene_text', 'create_video', 'pipeline')
+HEAVY_IMPORTS = ('cv2', 'pytesseract', 'moviepy', 'openai', 'httpx', 'pydub', 'aiohttp')
+IMPORT_PROBE = """
+import json, os, sys, time
+environ = dict(os.environ)
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+changed = sorted(name for name in set(environ) | set(os.environ) if environ.get(name) != os.environ.get(name))
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules], 'env': changed}}))
+"""
+# Written to the probe's directory, so a module that loads .env on import shows up as an environment change
+PROBE_DOTENV = "TEXTBOOK_IMPORT_PROBE=1\n"
+WORDS = ("output inflation demand supply market price rate growth capital labor policy interest "
+         "consumption investment savings equilibrium model shock wage money credit").split()
+
+def synthetic_paragraph(rng, n_words=60):
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + '.'
+
+def draw_figure(page, rng, y, label):
+    """Filled box with a few shapes and a 'Figure N.M' caption below, returns the next free y"""
+    rect = fitz.Rect(180, y, 432, y + 170)
+    page.draw_rect(rect, color=(0, 0, 0), fill=(0.85, 0.9, 1.0), width=1.5)
+    for _ in range(4):
+        x0, y0 = rng.uniform(rect.x0 + 10, rect.x1 - 60), rng.uniform(rect.y0 + 10, rect.y1 - 60)
+        page.draw_circle((x0 + 25, y0 + 25), rng.uniform(8, 25), color=(0.2, 0.2, 0.6), fill=(0.4, 0.5, 0.9))
+    page.draw_polyline([(rect.x0 + 15 + i * 25, rect.y1 - 15 - rng.uniform(0, 120)) for i in range(9)],
+                       color=(0.8, 0.1, 0.1), width=2)
+    page.insert_text((rect.x0, rect.y1 + 14), f"Figure {label} Synthetic chart of {rng.choice(WORDS)}", fontsize=9)
+    return rect.y1 + 30
+
+def draw_table(page, rng, y, label, rows=6, cols=4):
+    """'Table N.M' caption above a ruled grid of numbers, returns the next free y"""
+    page.insert_text((150, y + 10), f"Table {label} Synthetic values of {rng.choice(WORDS)}", fontsize=9)
+    top, cell_w, cell_h = y + 18, 78, 20
+    for r in range(rows + 1):
+        page.draw_line((150, top + r * cell_h), (150 + cols * cell_w, top + r * cell_h), width=1)
+    for c in range(cols + 1):
+        page.draw_line((150 + c * cell_w, top), (150 + c * cell_w, top + rows * cell_h), width=1)
+    for r in range(rows):
+        for c in range(cols):
+            page.insert_text((156 + c * cell_w, top + r * cell_h + 14), f"{rng.uniform(0, 100):.1f}", fontsize=8)
+    return top + rows * cell_h + 20
+
+def draw_equation(page, rng, y):
+    """Centered display equation, returns the next free y"""
+    a, b = rng.choice(WORDS)[0], rng.choice(WORDS)[0]
+    text = f"Y({a}) = {b} + {rng.randint(2, 9)} K({a}) - L({b}) / {rng.randint(2, 9)}"
+    width = fitz.get_text_length(text, fontsize=14)
+    page.insert_text(((page.rect.width - width) / 2, y + 20), text, fontsize=14)
+    return y + 50
+
+def draw_page(page, rng, page_num, figures_per_page, tables_per_page, equations_per_page):
+    """Header, body paragraphs mixed with figures, tables and equations, footer"""
+    page.insert_text((72, 50), f"Chapter {page_num // 10 + 1}  Synthetic Economics", fontsize=9)
+    page.insert_text((300, page.rect.height - 40), str(page_num + 1), fontsize=9)
+
+    def count(rate):
+        return int(rate) + (rng.random() < rate - int(rate))
+
+    items = (['figure'] * count(figures_per_page) + ['table'] * count(tables_per_page) +
+             ['equation'] * count(equations_per_page))
+    rng.shuffle(items)
+    items = ['paragraph'] + [item for visual in items for item in (visual, 'paragraph')]
+
+    y = 110
+    bottom = page.rect.height - 210
+    n_visual = 0
+    for item in items:
+        if y > bottom:
+            break
+        if item == 'paragraph':
+            rect = fitz.Rect(72, y, 540, y + 80)
+            page.insert_textbox(rect, synthetic_paragraph(rng), fontsize=10)
+            y = rect.y1 + 10
+        elif item == 'equation':
+            y = draw_equation(page, rng, y)
+        else:
+            n_visual += 1
+            label = f"{page_num // 10 + 1}.{page_num % 10 * 10 + n_visual}"
+            y = draw_figure(page, rng, y, label) if item == 'figure' else draw_table(page, rng, y, label)
+
+def make_synthetic_pdf(path, pages=20, figures_per_page=1.0, tables_per_page=0.5, equations_per_page=1.0,
+                       scanned_pages=0, seed=0):
+    """Write a textbook-like PDF. Fractional densities are per-page probabilities.
+    The last scanned_pages pages are image-only (no text layer), which exercises the OCR fallbacks"""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    scratch = fitz.open()
+    for page_num in range(pages):
+        if page_num < pages - scanned_pages:
+            draw_page(doc.new_page(), rng, page_num, figures_per_page, tables_per_page, equations_per_page)
+        else:
+            source = scratch.new_page()
+            draw_page(source, rng, page_num, figures_per_page, tables_per_page, equations_per_page)
+            page = doc.new_page()
+            page.insert_image(page.rect, pixmap=source.get_pixmap(dpi=150))
+    doc.save(path)
+    return path
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its finished children, in MB"""
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+def _run_stage(stage, pdf_path, work_dir, workers, full_scan=False):
+    """Runs in a fresh process so peak RSS and metrics belong to this stage alone"""
+    import metrics
+    output_directory = os.path.join(work_dir, stage)
+    os.makedirs(output_directory, exist_ok=True)
+    start = time.perf_counter()
+    if stage == 'parse':
+        import parse_textbook
+        outputs = parse_textbook.parse_pdf_content(
+            pdf_path, os.path.join(output_directory, 'parsed_elements.json'), workers=workers)
+    elif stage == 'figures':
+        import pdfFigureExtract
+        outputs = pdfFigureExtract.process_pdf_with_extra_large_margins(pdf_path, output_directory, workers=workers,
+                                                                        full_scan=full_scan)
+    else:
+        import equationExtract
+        outputs = equationExtract.process_pdf_for_equations(pdf_path, output_directory, full_scan=full_scan)
+    seconds = time.perf_counter() - start
+    counters = metrics.snapshot()['counters']
+    # ocr.calls includes the OCR fallback run in figure workers (_extract_figures_from_pages),
+    # whose metrics the parent merges
+    return {'seconds': seconds, 'outputs': len(outputs), 'peak_rss_mb': peak_rss_mb(),
+            'tesseract_calls': int(counters.get('ocr.calls', 0)), 'counters': counters}
+
+def run_stage(stage, pdf_path, work_dir, workers=1, full_scan=False):
+    # spawn, so each stage imports with the cache environment set by the caller
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_run_stage, stage, pdf_path, work_dir, workers, full_scan).result()
+
+def run_benchmark(pdf_path, stages=STAGES, cache='cold', workers=1, repeat=1, full_scan=False):
+    """Time each stage on pdf_path. cache='cold' gives every repeat an empty cache directory,
+    'warm' primes the cache once first, 'off' disables the stage cache (TEXTBOOK_CACHE=0).
+    full_scan=True skips the page index and analyzes every page"""
+    pages = len(fitz.open(pdf_path))
+    results = {}
+    saved_env = {name: os.environ.get(name) for name in ('TEXTBOOK_CACHE_DIR', 'TEXTBOOK_CACHE')}
+    work_root = tempfile.mkdtemp(prefix="textbook_bench_")
+    try:
+        if cache == 'off':
+            os.environ['TEXTBOOK_CACHE'] = '0'
+        else:
+            os.environ.pop('TEXTBOOK_CACHE', None)
+        for stage in stages:
+            runs = []
+            if cache == 'warm':
+                os.environ['TEXTBOOK_CACHE_DIR'] = os.path.join(work_root, f"cache_{stage}")
+                run_stage(stage, pdf_path, os.path.join(work_root, 'prime'), workers, full_scan)
+            for i in range(repeat):
+                if cache == 'cold':
+                    os.environ['TEXTBOOK_CACHE_DIR'] = os.path.join(work_root, f"cache_{stage}_{i}")
+                runs.append(run_stage(stage, pdf_path, os.path.join(work_root, f"run{i}"), workers, full_scan))
+            best = min(runs, key=lambda run: run['seconds'])
+            results[stage] = dict(best, pages_per_sec=pages / best['seconds'] if best['seconds'] else None,
+                                  all_seconds=[run['seconds'] for run in runs])
+            print(f"{stage:<10} {best['seconds']:8.2f} s  {results[stage]['pages_per_sec']:8.1f} pages/s  "
+                  f"{best['peak_rss_mb']:7.1f} MB  tesseract: {best['tesseract_calls']}  outputs: {best['outputs']}")
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    return {
+        'meta': {'pdf': os.path.basename(pdf_path), 'pages': pages, 'cache': cache, 'workers': workers,
+                 'full_scan': full_scan, 'repeat': repeat, 'python': platform.python_version(), 'machine': platform.machine(),
+                 'cpus': os.cpu_count(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'stages': results,
+    }
+
+def check_imports(modules=LIBRARY_MODULES, budget=1.0):
+    """Import each module in a fresh interpreter from a directory holding only a .env file. Returns the failures:
+    imports slower than budget seconds, heavy dependencies loaded eagerly, files written and environment
+    variables changed on import"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_dir, os.getenv('PYTHONPATH')])))
+    failures = []
+    print(f"{'module':<20} {'seconds':>8}  problems")
+    for module in modules:
+        scratch = tempfile.mkdtemp(prefix="textbook_import_")
+        try:
+            with open(os.path.join(scratch, '.env'), 'w') as f:
+                f.write(PROBE_DOTENV)
+            result = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module=module, heavy=HEAVY_IMPORTS)],
+                                    cwd=scratch, env=env, capture_output=True, text=True)
+            written = [name for name in os.listdir(scratch) if name != '.env']
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        if result.returncode != 0:
+            problems = [f"import failed: {result.stderr.strip().splitlines()[-1]}"]
+            seconds = float('nan')
+        else:
+            probe = json.loads(result.stdout.strip().splitlines()[-1])
+            seconds = probe['seconds']
+            problems = [f"loads {name}" for name in probe['heavy']]
+            if probe['env']:
+                problems.append(f"changes environment: {', '.join(probe['env'])}")
+            if seconds > budget:
+                problems.append(f"over the {budget:.2f} s budget")
+        if written:
+            problems.append(f"wrote {', '.join(sorted(written))}")
+        print(f"{module:<20} {seconds:>8.3f}  {'; '.join(problems) or 'ok'}")
+        failures.extend((module, problem) for problem in problems)
+    return failures
+
+def compare_results(baseline, current, threshold=0.10):
+    """Print per-stage changes and return the list of regressions beyond threshold (a fraction)"""
+    regressions = []
+    print(f"{'stage':<10} {'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for stage, base in baseline['stages'].items():
+        now = current['stages'].get(stage)
+        if now is None:
+            print(f"{stage:<10} missing from current run")
+            continue
+        # Higher is worse for every compared metric
+        for metric in ('seconds', 'peak_rss_mb', 'tesseract_calls'):
+            before, after = base[metric], now[metric]
+            change = (after - before) / before if before else (float('inf') if after else 0.0)
+            flag = change > threshold
+            if flag:
+                regressions.append((stage, metric, before, after))
+            print(f"{stage:<10} {metric:<16} {before:>10.2f} {after:>10.2f} {change:>+7.1%}{'  REGRESSION' if flag else ''}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the parsing and CV stages")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help="write a synthetic textbook PDF")
+    run = commands.add_parser('run', help="benchmark the stages on a synthetic (or given) PDF")
+    for command in (generate, run):
+        command.add_argument('--pages', type=int, default=20)
+        command.add_argument('--figures', type=float, default=1.0, help="figures per page")
+        command.add_argument('--tables', type=float, default=0.5, help="tables per page")
+        command.add_argument('--equations', type=float, default=1.0, help="equations per page")
+        command.add_argument('--scanned', type=int, default=0, help="image-only pages at the end")
+        command.add_argument('--seed', type=int, default=0)
+    generate.add_argument('output')
+    run.add_argument('--pdf', help="benchmark this PDF instead of generating one")
+    run.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    run.add_argument('--cache', choices=('cold', 'warm', 'off'), default='cold')
+    run.add_argument('--workers', type=int, default=1)
+    run.add_argument('--repeat', type=int, default=1)
+    run.add_argument('--full-scan', action='store_true', help="analyze every page instead of the indexed ones")
+    run.add_argument('--output', help="write results as JSON")
+
+    compare = commands.add_parser('compare', help="flag regressions between two result files")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.10)
+
+    imports = commands.add_parser('imports', help="check that modules import fast and without side effects")
+    imports.add_argument('modules', nargs='*', default=list(LIBRARY_MODULES))
+    imports.add_argument('--budget', type=float, default=1.0, help="seconds allowed per module import")
+    args = parser.parse_args(argv)
+
+    if args.command == 'imports':
+        failures = check_imports(args.modules, args.budget)
+        print(f"\n{len(failures)} import problem(s)")
+        return 1 if failures else 0
+
+    if args.command == 'generate':
+        make_synthetic_pdf(args.output, args.pages, args.figures, args.tables, args.equations, args.scanned, args.seed)
+        print(f"Wrote {args.pages} pages to {args.output}")
+        return 0
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare_results(baseline, current, args.threshold)
+        print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}")
+        return 1 if regressions else 0
+
+    pdf_path = args.pdf
+    generated_dir = None
+    if not pdf_path:
+        generated_dir = tempfile.mkdtemp(prefix="textbook_pdf_")
+        pdf_path = make_synthetic_pdf(os.path.join(generated_dir, 'synthetic.pdf'), args.pages, args.figures,
+                                      args.tables, args.equations, args.scanned, args.seed)
+    try:
+        results = run_benchmark(os.path.abspath(pdf_path), args.stages, args.cache, args.workers, args.repeat,
+                                args.full_scan)
+    finally:
+        if generated_dir:
+            shutil.rmtree(generated_dir, ignore_errors=True)
+    if not args.pdf:
+        results['meta'].update(figures=args.figures, tables=args.tables, equations=args.equations,
+                               scanned=args.scanned, seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
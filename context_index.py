@@ -0,0 +1,88 @@
+import re
+import numpy as np
+from element_store import ElementStore
+
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+LABEL_PATTERN = re.compile(r'\b(figure|table)\s*(\d+(?:\.\d+)*)')
+
+def tokenize(text):
+    return set(WORD_PATTERN.findall(text.lower()))
+
+def caption_label(text):
+    """('figure', '3.5') style label of a caption, or None"""
+    match = LABEL_PATTERN.search(text.lower())
+    return match.groups() if match else None
+
+def lexical_score(query, text):
+    """Token overlap between a scene title and a candidate, with a bonus for the same figure/table label"""
+    query_tokens = tokenize(query)
+    text_tokens = tokenize(text)
+    if not query_tokens or not text_tokens:
+        return 0.0
+    score = len(query_tokens & text_tokens) / len(query_tokens | text_tokens)
+    label = caption_label(query)
+    if label and label == caption_label(text):
+        score += 1.0
+    return score
+
+def element_text(element):
+    return element.get('text') or element.get('title') or ''
+
+class ContextIndex:
+    """Elements from parse_textbook indexed by page and vertical position, used to build
+    a compact pre/caption/post context for each scene without sending the whole PDF.
+    Takes an ElementStore or a list of elements, only pages that scenes touch are materialized"""
+
+    def __init__(self, elements):
+        self.store = elements if isinstance(elements, ElementStore) else ElementStore(elements)
+        self._pages = {}
+
+    def page_elements(self, page):
+        """Elements on a page sorted by y position"""
+        if page not in self._pages:
+            rows = self.store.rows_on_page(page)
+            rows = rows[np.argsort(self.store.y_positions[rows], kind='stable')]
+            self._pages[page] = [self.store.element(row) for row in rows.tolist()]
+        return self._pages[page]
+
+    def scene_page(self, scene):
+        # Scenes carry the 0-based page index from the figure file name, elements are 1-based
+        return int(scene['page_number']) + 1
+
+    def find_anchor(self, scene, window=1):
+        """Element the scene is anchored on: the best matching caption on its page,
+        falling back to the best lexical match within the page window"""
+        page = self.scene_page(scene)
+        captions = [e for e in self.page_elements(page) if e['type'] == 'figure_table']
+        if captions:
+            return max(captions, key=lambda e: lexical_score(scene['title'], element_text(e)))
+
+        candidates = [e for p in range(page - window, page + window + 1) for e in self.page_elements(p)]
+        scored = [(lexical_score(scene['title'], element_text(e)), i) for i, e in enumerate(candidates)]
+        best_score, best_index = max(scored, default=(0.0, None))
+        return candidates[best_index] if best_score > 0 else None
+
+    def scene_context(self, scene, window=1, max_chars=6000):
+        """Return {'pre_text', 'caption', 'post_text'} around the scene's figure/table"""
+        page = self.scene_page(scene)
+        anchor = self.find_anchor(scene, window)
+        anchor_page = anchor['page_number'] if anchor else page
+
+        before, after = [], []
+        for p in range(anchor_page - window, anchor_page + window + 1):
+            for element in self.page_elements(p):
+                if element['type'] == 'figure_table':
+                    continue
+                if p < anchor_page or (p == anchor_page and anchor and element['bottom_y'] <= anchor['y_position']):
+                    before.append(element_text(element))
+                else:
+                    after.append(element_text(element))
+
+        # Keep the text closest to the figure when trimming
+        pre_text = ' '.join(before)[-max_chars:]
+        post_text = ' '.join(after)[:max_chars]
+        return {
+            'pre_text': pre_text,
+            'caption': element_text(anchor) if anchor and anchor['type'] == 'figure_table' else '',
+            'post_text': post_text,
+        }
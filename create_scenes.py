@@ -1,11 +1,11 @@
 import os
 import json
-import pytesseract
-from PIL import Image
+import ocr_cache
 
 def extract_figure_info(image_path):
     """Extract figure/table name and number from image using OCR"""
-    text = pytesseract.image_to_string(Image.open(image_path)).lower()
+    # Shares the OCR cache with pdfFigureExtract, so unchanged crops cost no tesseract calls
+    text = ocr_cache.image_to_string(image_path).lower()
     
     # Look for figure or table references
     lines = text.split('\n')
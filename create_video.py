@@ -1,24 +1,122 @@
 import json
-from moviepy.editor import *
-from deepgram import (
-    DeepgramClient,
-    SpeakOptions,
-)
 import asyncio
 import os
+import weakref
+from functools import lru_cache
 from pathlib import Path
-import aiohttp
-import aiofiles
 import numpy as np
 from PIL import Image
-from dotenv import load_dotenv
 import re
-from pydub import AudioSegment
+import shutil
+import subprocess
+import tempfile
+import imageio_ffmpeg
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+from stage_cache import CACHE_ROOT, StageCache, default_cache, hash_bytes, hash_file, hash_json, make_key
 
-load_dotenv()
+VOICE_MODEL = "aura-asteria-en"
+# Raw 16-bit mono PCM straight from the TTS API, decoded once into NumPy
+SAMPLE_RATE = 24000
+AUDIO_FORMAT = {'encoding': 'linear16', 'container': 'none', 'sample_rate': SAMPLE_RATE}
+VIDEO_PARAMS = {'size': (1920, 1080), 'fps': 24, 'codec': 'libx264', 'audio_codec': 'aac', 'voice': VOICE_MODEL,
+                'audio': AUDIO_FORMAT}
+
+# Still-image render mode: each scene is one looped picture, so a low frame rate loses nothing
+STILL_FPS = 1
+STILL_ENCODER = ['-c:v', 'libx264', '-tune', 'stillimage', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '128k']
+RENDER_MODES = ('still', 'moviepy')
+
+# Per-process cap on in-flight TTS requests
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+# DEEPGRAM_URL points TTS at another endpoint, e.g. a local stand-in
+DEEPGRAM_URL = "https://api.deepgram.com"
+TTS_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+_tts_cache = None
+_tts_semaphores = weakref.WeakKeyDictionary()
+_tts_clients = weakref.WeakKeyDictionary()
+
+# moviepy and httpx are imported where they are used, so importing this module stays cheap
+
+@lru_cache(maxsize=None)
+def ffmpeg_exe():
+    """Path to the ffmpeg binary, looked up on first use"""
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def get_tts_client():
+    """One HTTP client per running loop, so every TTS request reuses its pooled keep-alive connections.
+    (The Deepgram SDK opens a new client, and a new connection, for every request)"""
+    loop = asyncio.get_running_loop()
+    if loop not in _tts_clients:
+        import httpx
+        _tts_clients[loop] = httpx.AsyncClient(
+            base_url=os.getenv("DEEPGRAM_URL", DEEPGRAM_URL),
+            headers={'Authorization': f"Token {os.getenv('DEEPGRAM_API_KEY', '')}"},
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_connections=TTS_CONCURRENCY, max_keepalive_connections=TTS_CONCURRENCY),
+        )
+    return _tts_clients[loop]
+
+async def close_tts_client():
+    """Close the running loop's TTS client, if one was opened"""
+    client = _tts_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+def get_tts_cache():
+    """Synthesized audio store, or None when caching is disabled with TEXTBOOK_CACHE=0"""
+    global _tts_cache
+    if os.getenv("TEXTBOOK_CACHE", "1") == "0":
+        return None
+    if _tts_cache is None:
+        _tts_cache = StageCache(os.path.join(CACHE_ROOT, "tts"), max_bytes=TTS_CACHE_MAX_BYTES)
+    return _tts_cache
+
+def normalize_chunk_text(chunk):
+    # Whitespace differences don't change the narration, so they shouldn't miss the cache
+    return ' '.join(chunk.split())
+
+def tts_cache_key(chunk):
+    return make_key('tts', dict(AUDIO_FORMAT, voice=VOICE_MODEL), [hash_bytes(chunk.encode('utf-8'))])
+
+def get_tts_semaphore():
+    # Semaphores belong to an event loop, keep one per running loop
+    loop = asyncio.get_running_loop()
+    if loop not in _tts_semaphores:
+        _tts_semaphores[loop] = asyncio.Semaphore(TTS_CONCURRENCY)
+    return _tts_semaphores[loop]
+
+async def synthesize_chunk(chunk, chunk_label):
+    """Synthesize one chunk to int16 PCM samples, returns the array or None"""
+    chunk = normalize_chunk_text(chunk)
+    cache = get_tts_cache()
+    key = tts_cache_key(chunk) if cache else None
+    cached = cache.get_bytes(key) if cache else None
+    if cached:
+        metrics.incr('tts.cache_hits')
+        return np.frombuffer(cached, dtype='<i2')
+    
+    async with get_tts_semaphore():
+        metrics.incr('tts.requests')
+        # Keep the response in memory instead of saving it to a file
+        with metrics.span('tts.request', label=chunk_label):
+            response = await get_tts_client().post('/v1/speak', params=dict(AUDIO_FORMAT, model=VOICE_MODEL),
+                                                   json={'text': chunk})
+            response.raise_for_status()
+    
+    data = response.content
+    if not data:
+        print(f"    >>No audio returned for chunk {chunk_label}")
+        return None
+    metrics.incr('tts.seconds', len(data) / 2 / SAMPLE_RATE)
+    if cache:
+        cache.put_bytes(key, data)
+    return np.frombuffer(data, dtype='<i2')
 
 async def generate_audio(text, scene_title):
-    """Generate audio file from text using Deepgram"""
+    """Generate audio samples (int16 PCM at SAMPLE_RATE) from text using Deepgram.
+    Returns None if any chunk fails, so a scene is never narrated (or cached) with parts missing"""
     DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
     if not DEEPGRAM_API_KEY:
         raise ValueError("DEEPGRAM_API_KEY environment variable not set")
@@ -29,74 +127,35 @@ async def generate_audio(text, scene_title):
         return None
     
     try:
-        # Initialize audio files list
-        audio_files = []
-        
-        # Split text into chunks at sentence boundaries
-        chunks = split_into_chunks(text)
+        # Split text into evenly sized chunks at sentence boundaries so no chunk dominates
+        chunks = split_into_chunks(text, balanced=True)
         print(f"    >>Split text into {len(chunks)} chunks for {scene_title}")
         
-        for i, chunk in enumerate(chunks):
-            temp_audio_file = f"temp_audio_{scene_title.replace(' ', '_')}_{i}.mp3"
-            print(f"    >>Generating audio for chunk {i+1}/{len(chunks)}")
-            
-            # Create Deepgram client
-            deepgram = DeepgramClient()
-            
-            # Configure TTS options
-            speak_text = {"text": chunk}
-            options = SpeakOptions(
-                model="aura-asteria-en",
-            )
-            
-            # Generate and save audio
-            response = await deepgram.speak.asyncrest.v("1").save(temp_audio_file, speak_text, options)
-            
-            if os.path.exists(temp_audio_file):
-                # Convert MP3 to WAV using pydub
-                try:
-                    audio = AudioSegment.from_file(temp_audio_file, format="mp3")
-                    wav_file = temp_audio_file.replace('.mp3', '.wav')
-                    audio.export(wav_file, format="wav")
-                    audio_files.append(wav_file)
-                    os.remove(temp_audio_file)  # Clean up MP3 file
-                except Exception as e:
-                    print(f"    >>Error converting audio for chunk {i+1}: {e}")
-                    continue
-            else:
-                print(f"    >>No audio file created for chunk {i+1}")
+        # Synthesize all chunks concurrently, gather keeps them in order
+        results = await asyncio.gather(
+            *(synthesize_chunk(chunk, f"{i+1}/{len(chunks)}") for i, chunk in enumerate(chunks)),
+            return_exceptions=True
+        )
+        failed = 0
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"    >>Error generating audio for chunk {i+1}: {result}")
+                failed += 1
+            elif result is None:
+                failed += 1
         
-        if not audio_files:
-            print(f"    >>No audio files created for {scene_title}")
+        if failed:
+            print(f"    >>{failed} of {len(chunks)} chunks failed for {scene_title}, no audio created")
             return None
-            
-        # If we have multiple chunks, concatenate them
-        if len(audio_files) > 1:
-            final_audio = f"audio_{scene_title.replace(' ', '_')}.wav"
-            concatenate_audio_files(audio_files, final_audio)
-            
-            # Clean up temporary files
-            for temp_file in audio_files:
-                os.remove(temp_file)
-                
-            return final_audio
-        else:
-            # If only one chunk, just return that file
-            return audio_files[0]
+        
+        return concatenate_audio(results)
             
     except Exception as e:
         print(f"    >>Error generating audio for {scene_title}: {e}")
-        # Clean up any temporary files that might have been created
-        for temp_file in audio_files:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
         return None
 
-def split_into_chunks(text, max_chars=1900):  # Using 1900 to leave some buffer
-    """Split text into chunks at sentence boundaries while respecting character limit"""
-    # First split into sentences
-    sentences = re.split('(?<=[.!?])\s+', text)
-    
+def pack_sentences(sentences, max_chars):
+    """Greedily pack sentences into chunks of at most max_chars (a longer sentence gets its own chunk)"""
     chunks = []
     current_chunk = ""
     
@@ -115,15 +174,42 @@ def split_into_chunks(text, max_chars=1900):  # Using 1900 to leave some buffer
     
     return chunks
 
-def concatenate_audio_files(audio_files, output_file):
-    """Concatenate multiple audio files into one"""
-    combined = AudioSegment.empty()
-    for audio_file in audio_files:
-        segment = AudioSegment.from_wav(audio_file)
-        combined += segment
-    combined.export(output_file, format="wav")
+def split_into_chunks(text, max_chars=1900, balanced=False):  # Using 1900 to leave some buffer
+    """Split text into chunks at sentence boundaries while respecting character limit.
+    balanced=True keeps the same number of chunks but evens out their sizes"""
+    # First split into sentences
+    sentences = re.split(r'(?<=[.!?])\s+', text)
+    chunks = pack_sentences(sentences, max_chars)
+    if not balanced or len(chunks) < 2:
+        return chunks
+    
+    # Smallest limit that still packs into the same number of chunks (chunk count only shrinks as the limit grows)
+    low, high = 1, max_chars
+    while low < high:
+        mid = (low + high) // 2
+        if len(pack_sentences(sentences, mid)) <= len(chunks):
+            high = mid
+        else:
+            low = mid + 1
+    return pack_sentences(sentences, low)
+
+def concatenate_audio(audio_chunks):
+    """Concatenate PCM chunks into one pre-sized buffer"""
+    combined = np.empty(sum(len(chunk) for chunk in audio_chunks), dtype=np.int16)
+    offset = 0
+    for chunk in audio_chunks:
+        combined[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return combined
+
+def audio_clip(samples):
+    """Wrap int16 PCM samples as a moviepy clip without writing them to disk"""
+    from moviepy.audio.AudioClip import AudioArrayClip
+    # moviepy's audio writer mishandles single-channel arrays (doubles the duration), so duplicate to stereo
+    mono = samples.astype(np.float32) / 32768.0
+    return AudioArrayClip(np.repeat(mono[:, None], 2, axis=1), fps=SAMPLE_RATE)
 
-def resize_image(image_path, target_size=(1920, 1080)):
+def resize_image(image_path, target_size=(1920, 1080), output_path=None):
     """Resize image to target size while maintaining aspect ratio"""
     img = Image.open(image_path)
     img_ratio = img.size[0] / img.size[1]
@@ -148,22 +234,24 @@ def resize_image(image_path, target_size=(1920, 1080)):
     new_img.paste(img, (x, y))
     
     # Save and return path
-    output_path = f"resized_{Path(image_path).name}"
+    if output_path is None:
+        output_path = f"resized_{Path(image_path).name}"
     new_img.save(output_path)
     return output_path
 
 async def create_scene_clip(scene):
     """Create video clip for a single scene"""
     # Generate audio for scene text
-    audio_file = await generate_audio(scene['text'], scene['title'])
-    if not audio_file:
+    samples = await generate_audio(scene['text'], scene['title'])
+    if samples is None:
         return None
     
     # Load and resize image
     resized_image = resize_image(scene['visual_path'])
     
     # Create video clip
-    audio = AudioFileClip(audio_file)
+    from moviepy.editor import ImageClip
+    audio = audio_clip(samples)
     image = ImageClip(resized_image)
     
     # Set duration to match audio
@@ -173,21 +261,108 @@ async def create_scene_clip(scene):
     final_clip = video.set_audio(audio)
     
     # Clean up temporary files
-    os.remove(audio_file)
     os.remove(resized_image)
     
     return final_clip
 
-async def create_video(scenes_file, output_file):
-    """Create complete video from all scenes"""
-    # Load scenes
-    with open(scenes_file, 'r') as f:
-        scenes = json.load(f)
+def encode_still_segment(image_path, samples, output_path):
+    """Encode a looped still image with the scene's PCM narration piped in through stdin"""
+    # Pad with silence to a whole number of frames so video and audio end together in every segment
+    frame_samples = SAMPLE_RATE // STILL_FPS
+    padding = -len(samples) % frame_samples
+    if padding:
+        samples = np.concatenate([samples, np.zeros(padding, dtype=np.int16)])
+    duration = len(samples) / SAMPLE_RATE
     
-    print(f"\nTotal scenes found: {len(scenes)}")
+    command = [
+        ffmpeg_exe(), '-y', '-loglevel', 'error',
+        '-loop', '1', '-framerate', str(STILL_FPS), '-i', image_path,
+        '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', '-i', 'pipe:0',
+        '-t', f'{duration:.6f}', *STILL_ENCODER, output_path,
+    ]
+    subprocess.run(command, input=samples.astype('<i2').tobytes(), check=True)
+
+def concat_segments(segment_paths, output_file):
+    """Join encoded segments with the concat demuxer, copying streams instead of re-encoding"""
+    list_path = f"{output_file}.segments.txt"
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        subprocess.run([
+            ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-c', 'copy', '-movflags', '+faststart', output_file,
+        ], check=True)
+    finally:
+        os.remove(list_path)
+
+def encode_scene_segment(visual_path, samples, segment_path):
+    """Process pool worker: letterbox the scene image and encode it with its narration"""
+    # Resize next to the segment so scenes sharing an image don't collide
+    resized_image = resize_image(visual_path, output_path=f"{segment_path}.png")
+    try:
+        encode_still_segment(resized_image, samples, segment_path)
+    finally:
+        os.remove(resized_image)
+    return segment_path
+
+def segment_cache_key(scene):
+    """Key a scene's segment on its image bytes, its narration and every setting that changes the encode.
+    Narration is keyed by its normalized text, voice and format, the same inputs the TTS cache uses"""
+    params = dict(size=VIDEO_PARAMS['size'], fps=STILL_FPS, encoder=STILL_ENCODER, voice=VOICE_MODEL, audio=AUDIO_FORMAT)
+    narration = normalize_chunk_text(scene['text'])
+    return make_key('segment', params, [hash_file(scene['visual_path']), hash_bytes(narration.encode('utf-8'))])
+
+async def create_scene_segment(scene, segment_path, pool, tts_limit, cache=None):
+    """Synthesize a scene's narration, then encode it in the pool. Returns the segment path or None"""
+    key = segment_cache_key(scene) if cache else None
+    cached_segment = cache.get_file(key) if cache else None
+    if cached_segment:
+        print(f"    Reusing cached segment for {scene['title']}")
+        shutil.copyfile(cached_segment, segment_path)
+        return segment_path
     
-    # Create clip for each scene
-    clips = []
+    async with tts_limit:
+        print(f"    Creating segment for scene {scene['title']}")
+        # Generate audio for scene text
+        samples = await generate_audio(scene['text'], scene['title'])
+    if samples is None:
+        print(f"    Failed to create segment for {scene['title']}")
+        return None
+    
+    # The TTS slot is already free, so the next scene's audio overlaps this encode
+    try:
+        with metrics.span('video.segment', label=scene['title']):
+            await asyncio.get_running_loop().run_in_executor(
+                pool, encode_scene_segment, scene['visual_path'], samples, segment_path)
+    except subprocess.CalledProcessError as e:
+        print(f"    Failed to create segment for {scene['title']}: {e}")
+        return None
+    metrics.incr('bytes_written', os.path.getsize(segment_path))
+    # generate_audio returned every chunk, so the segment matches the key's full scene text
+    if cache:
+        cache.put_file(key, segment_path)
+    
+    print(f"    Successfully created segment for {scene['title']}")
+    return segment_path
+
+def render_params(mode):
+    if mode == 'still':
+        return dict(VIDEO_PARAMS, mode=mode, fps=STILL_FPS, encoder=STILL_ENCODER)
+    return dict(VIDEO_PARAMS, mode=mode)
+
+def video_cache_key(scenes, mode='still'):
+    """Key the rendered video on every scene's text and image bytes plus the render settings"""
+    inputs = []
+    for scene in scenes:
+        visual_path = scene.get('visual_path')
+        visual_hash = hash_file(visual_path) if visual_path and os.path.exists(visual_path) else None
+        inputs.append(hash_json([scene.get('title'), scene.get('text'), visual_hash]))
+    return make_key('video', render_params(mode), inputs)
+
+def renderable_scenes(scenes):
+    """Yield (index, scene) for scenes that have both a visual and text"""
     for i, scene in enumerate(scenes):
         print(f"\nProcessing scene {i+1}/{len(scenes)}: {scene['title']}")
         
@@ -203,13 +378,51 @@ async def create_video(scenes_file, output_file):
             print(f"    Skipping scene {scene['title']}: Image file not found at {scene['visual_path']}")
             continue
         
-        print(f"    Creating clip for scene {scene['title']}")
-        clip = await create_scene_clip(scene)
+        yield i, scene
+
+async def render_still(scenes, output_file, workers=None, scene_concurrency=4, cache=None):
+    """Pipeline scene TTS into a process pool that encodes still-image segments, then join them with stream copy.
+    With a cache, unchanged scenes reuse their segment and only new or edited scenes are encoded.
+    Returns True if every renderable scene made it into the video"""
+    segment_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(output_file)))
+    tts_limit = asyncio.Semaphore(scene_concurrency)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # gather keeps the segments in scene order
+            results = await asyncio.gather(*(
+                create_scene_segment(scene, os.path.join(segment_dir, f"segment_{i:04d}.mp4"), pool, tts_limit, cache)
+                for i, scene in renderable_scenes(scenes)
+            ))
+        segments = [segment for segment in results if segment]
+        
+        print(f"\nTotal segments created: {len(segments)}")
+        
+        if not segments:
+            raise ValueError("No valid clips were created")
+        
+        print("\nJoining segments...")
+        concat_segments(segments, output_file)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+    return len(segments) == len(results)
+
+async def render_moviepy(scenes, output_file, scene_concurrency=4):
+    """Composite and encode every frame through moviepy, returns True if every renderable scene made it in"""
+    tts_limit = asyncio.Semaphore(scene_concurrency)
+    
+    async def scene_clip(scene):
+        async with tts_limit:
+            print(f"    Creating clip for scene {scene['title']}")
+            clip = await create_scene_clip(scene)
         if clip:
-            clips.append(clip)
             print(f"    Successfully created clip for {scene['title']}")
         else:
             print(f"    Failed to create clip for {scene['title']}")
+        return clip
+    
+    # Create clip for each scene, with narration for several scenes in flight
+    results = await asyncio.gather(*(scene_clip(scene) for _, scene in renderable_scenes(scenes)))
+    clips = [clip for clip in results if clip]
     
     print(f"\nTotal clips created: {len(clips)}")
     
@@ -218,6 +431,7 @@ async def create_video(scenes_file, output_file):
     
     # Concatenate all clips
     print("\nConcatenating clips...")
+    from moviepy.editor import concatenate_videoclips
     final_video = concatenate_videoclips(clips)
     
     # Write final video
@@ -232,8 +446,52 @@ async def create_video(scenes_file, output_file):
     # Clean up clips
     for clip in clips:
         clip.close()
+    return len(clips) == len(results)
+
+async def create_video(scenes_file, output_file, cache=None, mode='still', workers=None, scene_concurrency=4):
+    """Create complete video from all scenes.
+    mode='still' encodes each scene as a looped still image, mode='moviepy' renders every frame.
+    scene_concurrency scenes synthesize narration at once, workers processes encode segments (default: CPU count).
+    scenes_file may also be the scene list itself"""
+    if mode not in RENDER_MODES:
+        raise ValueError(f"Unknown render mode {mode!r}, expected one of {RENDER_MODES}")
+    
+    # Load scenes
+    if isinstance(scenes_file, (str, os.PathLike)):
+        with open(scenes_file, 'r') as f:
+            scenes = json.load(f)
+    else:
+        scenes = list(scenes_file)
+    
+    print(f"\nTotal scenes found: {len(scenes)}")
+    
+    # Reuse the last render when no scene input or setting changed
+    cache = cache or default_cache()
+    key = video_cache_key(scenes, mode) if cache else None
+    cached_video = cache.get_file(key) if cache else None
+    if cached_video:
+        print("\nScenes unchanged, reusing cached video")
+        shutil.copyfile(cached_video, output_file)
+        return
+    
+    with metrics.span('video', profile=True):
+        try:
+            if mode == 'still':
+                complete = await render_still(scenes, output_file, workers, scene_concurrency, cache)
+            else:
+                complete = await render_moviepy(scenes, output_file, scene_concurrency)
+        finally:
+            await close_tts_client()
+    # A video missing failed scenes is still written, but never cached under the key of the full scene list
+    if cache and complete:
+        cache.put_file(key, output_file)
+    elif cache:
+        print("\nSome scenes failed, video not cached")
 
 if __name__ == "__main__":
+    # Read API keys from .env only when run as a script, importing this module leaves the environment alone
+    from dotenv import load_dotenv
+    load_dotenv()
     scenes_file = "complete_scenes.json"
     output_file = "textbook_video.mp4"
     
@@ -241,4 +499,4 @@ if __name__ == "__main__":
         asyncio.run(create_video(scenes_file, output_file))
         print(f"Video successfully created: {output_file}")
     except Exception as e:
-        print(f"Error creating video: {e}") 
\ No newline at end of file
+        print(f"Error creating video: {e}") 
@@ -0,0 +1,141 @@
+import json
+import numpy as np
+
+ELEMENT_TYPES = ('paragraph', 'figure_table', 'equation')
+TYPE_CODES = {name: code for code, name in enumerate(ELEMENT_TYPES)}
+PARAGRAPH, FIGURE_TABLE, EQUATION = range(len(ELEMENT_TYPES))
+
+def pack_strings(strings):
+    """Strings (or None) as one utf-8 buffer, end offsets and a null mask"""
+    encoded = [(s or '').encode('utf-8') for s in strings]
+    offsets = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+    nulls = np.array([s is None for s in strings], dtype=bool)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, nulls
+
+def unpack_strings(buffer, offsets, nulls):
+    data = buffer.tobytes()
+    starts = np.concatenate([[0], offsets[:-1]]).astype(np.int64)
+    return [None if null else data[start:end].decode('utf-8')
+            for start, end, null in zip(starts.tolist(), offsets.tolist(), nulls.tolist())]
+
+class ElementStore:
+    """parse_textbook elements as typed columns with a per-page row index.
+    Rows keep document order, element(row) rebuilds the original dict"""
+
+    def __init__(self, elements=()):
+        types, pages, y_positions, bottom_ys, texts, file_paths, associated = [], [], [], [], [], [], []
+        visual_rows = {}  # (type, title, file_path) -> latest row, to resolve associated_element dicts
+        for row, element in enumerate(elements):
+            code = TYPE_CODES[element['type']]
+            types.append(code)
+            pages.append(element['page_number'])
+            y_positions.append(element['y_position'])
+            bottom_ys.append(element['bottom_y'])
+            texts.append(element['title'] if code == FIGURE_TABLE else element['text'])
+            file_paths.append(element.get('file_path'))
+            if code != PARAGRAPH and element.get('file_path'):
+                visual_rows[element['type'], element.get('title', ''), element['file_path']] = row
+            # Paragraphs link to the nearest preceding visual with the same description
+            linked = element.get('associated_element')
+            associated.append(visual_rows.get((linked['type'], linked['title'], linked['file_path']), -1)
+                              if linked else -1)
+
+        self.types = np.array(types, dtype=np.int8)
+        self.pages = np.array(pages, dtype=np.int32)
+        self.y_positions = np.array(y_positions, dtype=np.float64)
+        self.bottom_ys = np.array(bottom_ys, dtype=np.float64)
+        self.texts = texts
+        self.file_paths = file_paths
+        self.associated = np.array(associated, dtype=np.int32)
+        self._build_page_index()
+
+    def _build_page_index(self):
+        # Stable sort keeps document order within a page
+        order = np.argsort(self.pages, kind='stable')
+        pages, starts = np.unique(self.pages[order], return_index=True)
+        self.page_index = dict(zip(pages.tolist(), np.split(order, starts[1:])))
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        return (self.element(row) for row in range(len(self)))
+
+    def rows_on_page(self, page_number):
+        return self.page_index.get(page_number, np.empty(0, dtype=np.int64))
+
+    def element(self, row):
+        """The element at row as the dict parse_textbook produced (same keys and order)"""
+        code = self.types[row]
+        element = {'type': ELEMENT_TYPES[code]}
+        if code == FIGURE_TABLE:
+            element['title'] = self.texts[row]
+        else:
+            element['text'] = self.texts[row]
+        element['page_number'] = int(self.pages[row])
+        if code == PARAGRAPH:
+            element['associated_element'] = self.associated_element(row)
+        else:
+            element['file_path'] = self.file_paths[row]
+        element['y_position'] = float(self.y_positions[row])
+        element['bottom_y'] = float(self.bottom_ys[row])
+        return element
+
+    def associated_element(self, row):
+        visual = self.associated[row]
+        if visual < 0:
+            return None
+        return {
+            'type': ELEMENT_TYPES[self.types[visual]],
+            'title': self.texts[visual] if self.types[visual] == FIGURE_TABLE else '',
+            'file_path': self.file_paths[visual],
+        }
+
+    def take(self, rows):
+        """New store with only the given rows, associations remapped (dropped visuals become None)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        new_rows = np.full(len(self) + 1, -1, dtype=np.int32)  # Last slot maps -1 to -1
+        new_rows[rows] = np.arange(len(rows), dtype=np.int32)
+
+        store = ElementStore.__new__(ElementStore)
+        store.types = self.types[rows]
+        store.pages = self.pages[rows]
+        store.y_positions = self.y_positions[rows]
+        store.bottom_ys = self.bottom_ys[rows]
+        store.texts = [self.texts[row] for row in rows.tolist()]
+        store.file_paths = [self.file_paths[row] for row in rows.tolist()]
+        store.associated = new_rows[self.associated[rows]]
+        store._build_page_index()
+        return store
+
+    def save(self, path):
+        """Columnar .npz: numeric columns as arrays, strings as a utf-8 buffer plus offsets"""
+        text_buffer, text_offsets, text_nulls = pack_strings(self.texts)
+        path_buffer, path_offsets, path_nulls = pack_strings(self.file_paths)
+        np.savez(path, types=self.types, pages=self.pages, y_positions=self.y_positions,
+                 bottom_ys=self.bottom_ys, associated=self.associated,
+                 text_buffer=text_buffer, text_offsets=text_offsets, text_nulls=text_nulls,
+                 path_buffer=path_buffer, path_offsets=path_offsets, path_nulls=path_nulls)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            store = cls.__new__(cls)
+            store.types = data['types']
+            store.pages = data['pages']
+            store.y_positions = data['y_positions']
+            store.bottom_ys = data['bottom_ys']
+            store.associated = data['associated']
+            store.texts = unpack_strings(data['text_buffer'], data['text_offsets'], data['text_nulls'])
+            store.file_paths = unpack_strings(data['path_buffer'], data['path_offsets'], data['path_nulls'])
+        store._build_page_index()
+        return store
+
+def load_elements(path):
+    """ElementStore from a columnar .npz, a JSONL file or a JSON list"""
+    if str(path).endswith('.npz'):
+        return ElementStore.load(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        if str(path).endswith('.jsonl'):
+            return ElementStore(json.loads(line) for line in f if line.strip())
+        return ElementStore(json.load(f))
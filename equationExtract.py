@@ -1,9 +1,21 @@
 import os
 import fitz
-import cv2
-import pytesseract
-from PIL import Image
 import numpy as np
+import metrics
+from page_index import MATH_FONT, select_pages
+from parse_textbook import MATH_SYMBOLS
+from pdf_pages import PageCache
+from stage_cache import cached_page_outputs, default_cache, make_key, page_content_hash
+
+# Detection settings, read by the detectors and part of the stage cache key for every page.
+# center: largest offset from the page center as a share of its width, margins: crop margins as a share of (w, h)
+EQUATION_PARAMS = {'zoom': 3, 'blur': 5, 'min_size': (50, 20), 'aspect_ratio': (1.0, 20.0), 'center': 0.15,
+                   'padding': 50, 'white_threshold': 250, 'white_ratio': 0.85, 'margins': (0.1, 0.3),
+                   'line_width': 0.7, 'line_center': 0.15, 'line_gap': 4}
+# Bump when the detection code changes, so cached crops from the old code are not reused
+EQUATIONS_VERSION = 1
+# Building an integral image costs about this many direct whitespace scans per pixel
+INTEGRAL_PIXEL_COST = 3
 
 def is_equation_region(image, x, y, w, h, page_width):
     """
@@ -15,83 +27,200 @@ def is_equation_region(image, x, y, w, h, page_width):
     # Check if centered
     content_center = x + (w/2)
     page_center = page_width/2
-    margin = page_width * 0.15  # 15% margin of error
+    margin = page_width * EQUATION_PARAMS['center']  # 15% margin of error
     if abs(content_center - page_center) > margin:
         return False
     
     # Check for whitespace around region
-    padding = 50
+    padding = EQUATION_PARAMS['padding']
     y1 = max(0, y - padding)
     y2 = min(image.shape[0], y + h + padding)
     x1 = max(0, x - padding)
     x2 = min(image.shape[1], x + w + padding)
     
     surrounding = image[y1:y2, x1:x2]
-    white_ratio = np.sum(surrounding > 250) / surrounding.size
-    if white_ratio < 0.85:  # Require 85% whitespace around equation
+    white_ratio = np.sum(surrounding > EQUATION_PARAMS['white_threshold']) / surrounding.size
+    if white_ratio < EQUATION_PARAMS['white_ratio']:  # Require 85% whitespace around equation
         return False
     
     return True
 
-def process_pdf_for_equations(pdf_path, output_directory):
-    doc = fitz.open(pdf_path)
-    extracted_files = []
+def whitespace_integral(gray, threshold=EQUATION_PARAMS['white_threshold']):
+    """Summed-area table (int32, one extra leading row and column) of the whitespace mask gray > threshold"""
+    import cv2
+    return cv2.integral(cv2.threshold(gray, threshold, 1, cv2.THRESH_BINARY)[1])
+
+def window_whitespace(gray, y1, y2, x1, x2, threshold=EQUATION_PARAMS['white_threshold']):
+    """Whitespace pixel count inside each window [y1:y2, x1:x2].
+    Heavily overlapping windows share one integral image of their bounding region (four lookups per window),
+    otherwise they are counted directly since building the integral would cost more than the scans"""
+    top, bottom, left, right = y1.min(), y2.max(), x1.min(), x2.max()
+    if ((y2 - y1) * (x2 - x1)).sum() <= INTEGRAL_PIXEL_COST * (bottom - top) * (right - left):
+        return np.array([np.count_nonzero(gray[a:b, c:d] > threshold)
+                         for a, b, c, d in zip(y1.tolist(), y2.tolist(), x1.tolist(), x2.tolist())], dtype=np.int64)
     
-    for page_num in range(len(doc)):
-        # Increase resolution significantly for better equation detection
-        page = doc.load_page(page_num)
-        pixmap = page.get_pixmap(matrix=fitz.Matrix(3, 3))  # Higher resolution
-        image_path = os.path.join(output_directory, f'page_{page_num}.png')
-        pixmap.save(image_path)
-        
-        # Load and preprocess image
-        image = cv2.imread(image_path)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Enhanced preprocessing
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        thresh = cv2.threshold(blurred, 0, 255, 
-                             cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
-        
-        # Find contours
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, 
-                                     cv2.CHAIN_APPROX_SIMPLE)
+    integral = whitespace_integral(gray[top:bottom, left:right], threshold)
+    y1, y2, x1, x2 = y1 - top, y2 - top, x1 - left, x2 - left
+    return integral[y2, x2].astype(np.int64) - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+
+def equation_boxes(boxes, gray, page_width, params=EQUATION_PARAMS):
+    """Vectorized size, shape and is_equation_region tests over bounding boxes (N, 4).
+    Returns the indices of the boxes that pass"""
+    min_size, aspect_ratio, padding = params['min_size'], params['aspect_ratio'], params['padding']
+    x, y, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    aspect = np.divide(w, h, out=np.zeros(len(boxes)), where=h > 0)
+    keep = (w >= min_size[0]) & (h >= min_size[1]) & (aspect >= aspect_ratio[0]) & (aspect <= aspect_ratio[1])
+    # Centered within 15% of the page width
+    keep &= np.abs(x + w / 2 - page_width / 2) <= page_width * params['center']
+    candidates = np.flatnonzero(keep)
+    if len(candidates) == 0:
+        return candidates
+    
+    # Whitespace around each region, the window clipped to the page
+    x, y, w, h = x[candidates], y[candidates], w[candidates], h[candidates]
+    y1, y2 = np.maximum(y - padding, 0), np.minimum(y + h + padding, gray.shape[0])
+    x1, x2 = np.maximum(x - padding, 0), np.minimum(x + w + padding, gray.shape[1])
+    white = window_whitespace(gray, y1, y2, x1, x2, params['white_threshold'])
+    return candidates[white / ((y2 - y1) * (x2 - x1)) >= params['white_ratio']]
+
+def is_math_line(line):
+    """True if any span of a get_text('dict') line is set in a math font or contains a math symbol"""
+    return any(MATH_FONT.search(span['font']) or not MATH_SYMBOLS.isdisjoint(span['text']) for span in line['spans'])
+
+def text_equation_rects(page, line_width=EQUATION_PARAMS['line_width'], line_center=EQUATION_PARAMS['line_center'],
+                        line_gap=EQUATION_PARAMS['line_gap']):
+    """Display-equation rectangles from the text layer, top to bottom: math lines centered within
+    line_center of the page width and narrower than line_width of a body text line. Stacked lines
+    (fractions, aligned equations) closer than line_gap points are merged.
+    Returns None for pages without a text layer"""
+    width = page.rect.width
+    lines = [line for block in page.get_text('dict')['blocks'] for line in block.get('lines', [])
+             if any(span['text'].strip() for span in line['spans'])]
+    if not lines:
+        return None
+    # Full lines of the text column, which is often much narrower than the page
+    body_width = np.percentile([line['bbox'][2] - line['bbox'][0] for line in lines], 90)
+    
+    rects = []
+    for line in sorted(lines, key=lambda line: line['bbox'][1]):
+        rect = fitz.Rect(line['bbox'])
+        if (rect.width > body_width * line_width or abs((rect.x0 + rect.x1) / 2 - width / 2) > width * line_center
+                or not is_math_line(line)):
+            continue
+        if rects and rect.y0 - rects[-1].y1 < line_gap:
+            rects[-1] |= rect
+        else:
+            rects.append(rect)
+    return rects
+
+def detect_text_equations(page, page_num, output_directory, rects, params=EQUATION_PARAMS):
+    """Rasterize only the equation rectangles at the detection zoom, with the same margins as the raster crops"""
+    extracted_files = []
+    zoom = params['zoom']
+    for i, rect in enumerate(rects):
+        margin_x, margin_y = rect.width * params['margins'][0], rect.height * params['margins'][1]
+        clip = fitz.Rect(rect.x0 - margin_x, rect.y0 - margin_y, rect.x1 + margin_x, rect.y1 + margin_y) & page.rect
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip)
         
-        # Sort contours by y-coordinate to maintain order
-        contours = sorted(contours, key=lambda c: cv2.boundingRect(c)[1])
+        equation_path = os.path.join(output_directory, f'equation_page{page_num}_{i}.png')
+        pixmap.save(equation_path)
+        metrics.incr('equations.crops')
+        metrics.incr('bytes_written', os.path.getsize(equation_path))
+        extracted_files.append(equation_path)
+    
+    return extracted_files, None
+
+def detect_equations_on_page(page_cache, page_num, output_directory, text_layer=True, params=EQUATION_PARAMS):
+    """Detect and save equation crops on one page, returns (extracted_files, None).
+    Equations are located from the text layer when the page has one, so only their clips are rendered.
+    Pages without text (scans) and text_layer=False fall back to full-page raster detection"""
+    if text_layer:
+        page = page_cache.doc.load_page(page_num)
+        rects = text_equation_rects(page, params['line_width'], params['line_center'], params['line_gap'])
+        if rects is not None:
+            return detect_text_equations(page, page_num, output_directory, rects, params)
+    metrics.incr('equations.raster_pages')
+    return detect_raster_equations(page_cache, page_num, output_directory, params)
+
+def detect_raster_equations(page_cache, page_num, output_directory, params=EQUATION_PARAMS):
+    """Contour-based detection on the whole page rendered at the detection zoom (3x)"""
+    import cv2  # Loaded on first use, importing this module stays cheap
+    extracted_files = []
+    
+    # Increase resolution significantly for better equation detection
+    image = page_cache.get(page_num, zoom=params['zoom'])  # Higher resolution
+    
+    # Preprocess image
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    
+    # Enhanced preprocessing
+    blurred = cv2.GaussianBlur(gray, (params['blur'], params['blur']), 0)
+    thresh = cv2.threshold(blurred, 0, 255, 
+                         cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    
+    # Find contours
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, 
+                                 cv2.CHAIN_APPROX_SIMPLE)
+    
+    # Sort boxes by y-coordinate to maintain order, stable so equation numbering matches the contour order
+    boxes = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int64).reshape(-1, 4)
+    boxes = boxes[np.argsort(boxes[:, 1], kind='stable')]
+    
+    for i in equation_boxes(boxes, gray, image.shape[1], params).tolist():
+        x, y, w, h = boxes[i].tolist()
+        # Add margins
+        margin_x = int(w * params['margins'][0])
+        margin_y = int(h * params['margins'][1])
+        x_crop = max(x - margin_x, 0)
+        y_crop = max(y - margin_y, 0)
+        w_crop = min(w + 2 * margin_x, image.shape[1] - x_crop)
+        h_crop = min(h + 2 * margin_y, image.shape[0] - y_crop)
         
-        for i, contour in enumerate(contours):
-            x, y, w, h = cv2.boundingRect(contour)
-            
-            # Filter based on size and aspect ratio
-            aspect_ratio = w / float(h)
-            if (w < 50 or h < 20 or  # Too small
-                aspect_ratio < 1.0 or aspect_ratio > 20.0):  # Wrong shape
-                continue
-            
-            if is_equation_region(gray, x, y, w, h, image.shape[1]):
-                # Add margins
-                margin_x = int(w * 0.1)
-                margin_y = int(h * 0.3)
-                x_crop = max(x - margin_x, 0)
-                y_crop = max(y - margin_y, 0)
-                w_crop = min(w + 2 * margin_x, image.shape[1] - x_crop)
-                h_crop = min(h + 2 * margin_y, image.shape[0] - y_crop)
-                
-                # Extract equation region
-                equation = image[y_crop:y_crop+h_crop, x_crop:x_crop+w_crop]
-                
-                # Save equation
-                equation_path = os.path.join(output_directory, 
-                                           f'equation_page{page_num}_{i}.png')
-                cv2.imwrite(equation_path, equation)
-                extracted_files.append(equation_path)
+        # Extract equation region
+        equation = image[y_crop:y_crop+h_crop, x_crop:x_crop+w_crop]
         
-        os.remove(image_path)
+        # Save equation
+        equation_path = os.path.join(output_directory, 
+                                   f'equation_page{page_num}_{i}.png')
+        cv2.imwrite(equation_path, cv2.cvtColor(equation, cv2.COLOR_RGB2BGR))
+        metrics.incr('equations.crops')
+        metrics.incr('bytes_written', os.path.getsize(equation_path))
+        extracted_files.append(equation_path)
+    
+    return extracted_files, None
+
+def extract_equations_from_page(page_cache, page_num, output_directory, cache=None, text_layer=True):
+    """Equation crops for one page, restored from the stage cache when the page content is unchanged"""
+    with metrics.span('equations.page', label=page_num):
+        if cache is None:
+            return detect_equations_on_page(page_cache, page_num, output_directory, text_layer)
+        key = make_key('equations', dict(EQUATION_PARAMS, version=EQUATIONS_VERSION, page_num=page_num,
+                                         text_layer=text_layer),
+                       [page_content_hash(page_cache.doc, page_num)])
+        return cached_page_outputs(cache, key, output_directory,
+                                   lambda: detect_equations_on_page(page_cache, page_num, output_directory, text_layer))
+
+def process_pdf_for_equations(pdf_path, output_directory, page_cache=None, cache=None, text_layer=True,
+                              pages=None, full_scan=False):
+    """text_layer=False forces full-page raster detection on every analyzed page.
+    Only pages the PageIndex flags for equations are analyzed, unless pages lists them or full_scan is set.
+    The index reads the text layer too, so text_layer=False without pages also scans every page"""
+    if page_cache is None:
+        page_cache = PageCache(pdf_path)
+    cache = cache or default_cache()
+    extracted_files = []
+    
+    with metrics.span('equations', profile=True):
+        page_numbers = select_pages(page_cache.doc, pages, full_scan or not text_layer, kind='equation')
+        metrics.incr('equations.pages_skipped', len(page_cache.doc) - len(page_numbers))
+        for page_num in page_numbers:
+            page_files, _ = extract_equations_from_page(page_cache, page_num, output_directory, cache, text_layer)
+            extracted_files.extend(page_files)
     
     return extracted_files
 
-# Create output directory and process PDF
-output_dir = './extracted_equations'
-os.makedirs(output_dir, exist_ok=True)
-equation_files = process_pdf_for_equations("macro.pdf", output_dir) 
\ No newline at end of file
+if __name__ == "__main__":
+    # Create output directory and process PDF
+    output_dir = './extracted_equations'
+    os.makedirs(output_dir, exist_ok=True)
+    equation_files = process_pdf_for_equations("macro.pdf", output_dir) 
\ No newline at end of file
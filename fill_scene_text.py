@@ -1,8 +1,17 @@
 import os
+import sys
 import json
-from openai import OpenAI
-from pathlib import Path
+import asyncio
 import time
+import fitz
+import metrics
+from stage_cache import default_cache, make_key, page_content_hash
+from openai_resources import (ResourceRegistry, ensure_assistant, ensure_assistant_async,
+                              ensure_pdf_resources, ensure_pdf_resources_async, poll_delays)
+from context_index import ContextIndex
+from element_store import load_elements
+
+FAILED_RUN_STATUSES = ("failed", "cancelled", "expired", "incomplete")
 
 def load_pdf_content(pdf_path):
     """Load PDF content as bytes to send to GPT-4"""
@@ -19,13 +28,7 @@ def clean_text(text):
     cleaned = cleaned.encode('ascii', 'ignore').decode()
     return cleaned
 
-def create_scene_text_prompt(scene):
-    """Create a prompt for GPT-4 to fill in text for a single scene"""
-    return f"""I have a scene from a textbook PDF document associated with {scene['title']} on page {scene['page_number']}.
-    Your task is to:
-    1. Read the text around this page in the PDF
-    2. Identify the text that belongs to this {scene['title']}
-    
+SCENE_TEXT_REQUIREMENTS = """    
     Critical Requirements:
     - Include all relevant text for this scene
     - Include text before and after the figure/table that directly relates to it
@@ -36,15 +39,98 @@ def create_scene_text_prompt(scene):
     
     Output a json in the format:
     '''json
-    {{
+    {
         "pre_text": "text that introduces or leads into the figure/table",
         "scene_text": "text that is part of the figure/table itself (captions, labels, etc)",
         "post_text": "text that follows and directly relates to the figure/table"
-    }}
+    }
     '''
     """
 
-def process_single_scene(client, thread, assistant, scene, file):
+def create_scene_text_prompt(scene, context=None):
+    """Create a prompt for GPT-4 to fill in text for a single scene.
+    With a context from ContextIndex the surrounding text is sent inline instead of searched in the PDF"""
+    if context is not None:
+        return f"""I have a scene from a textbook PDF document associated with {scene['title']} on page {scene['page_number']}.
+    Here is the textbook text around it.
+    
+    Text before the figure/table:
+    ---
+    {context['pre_text']}
+    ---
+    Caption:
+    ---
+    {context['caption']}
+    ---
+    Text after the figure/table:
+    ---
+    {context['post_text']}
+    ---
+    
+    Your task is to:
+    1. Read the text above
+    2. Identify the text that belongs to this {scene['title']}
+""" + SCENE_TEXT_REQUIREMENTS
+    
+    return f"""I have a scene from a textbook PDF document associated with {scene['title']} on page {scene['page_number']}.
+    Your task is to:
+    1. Read the text around this page in the PDF
+    2. Identify the text that belongs to this {scene['title']}
+""" + SCENE_TEXT_REQUIREMENTS
+
+def check_run_status(run, scene):
+    if run.status in FAILED_RUN_STATUSES:
+        raise RuntimeError(f"Run for {scene['title']} ended with status {run.status}")
+
+def parse_scene_response(response):
+    """Extract the scene JSON from the model's markdown response"""
+    json_content = None
+    try:
+        # Look for JSON between ```json and ``` markers
+        json_start = response.find("```json")
+        if json_start == -1:
+            # Try alternative format with '''json
+            json_start = response.find("'''json")
+            json_end = response.find("'''", json_start + 6) if json_start != -1 else -1
+        else:
+            json_end = response.find("```", json_start + 6)
+            
+        if json_start == -1 or json_end == -1:
+            raise ValueError(f"Could not find JSON content between markdown code blocks")
+            
+        # Extract just the JSON portion (skipping the markers)
+        json_content = response[json_start + 7:json_end].strip()
+        
+        # Parse the JSON
+        scene_data = json.loads(json_content)
+        
+        return scene_data
+        
+    except json.JSONDecodeError as e:
+        print(f"JSON parsing error: {e}")
+        print("Raw JSON content:", json_content)
+        raise
+
+def scene_text_from_data(scene_data):
+    return (
+        clean_text(scene_data.get('pre_text', '')) + 
+        clean_text(scene_data.get('scene_text', '')) + 
+        clean_text(scene_data.get('post_text', ''))
+    )
+
+def record_usage(usage):
+    """Count LLM tokens from a chat completion or a finished run"""
+    if usage is not None:
+        metrics.incr('llm.prompt_tokens', usage.prompt_tokens)
+        metrics.incr('llm.completion_tokens', usage.completion_tokens)
+
+def message_attachments(file):
+    # Without a file the assistant searches its own registered vector store
+    if file is None:
+        return None
+    return [{"file_id": file.id, "tools": [{"type": "file_search"}]}]
+
+def process_single_scene(client, thread, assistant, scene, file=None, scene_timeout=120):
     """Process a single scene and return its text content"""
     # Create message with prompt for this scene
     prompt = create_scene_text_prompt(scene)
@@ -54,7 +140,7 @@ def process_single_scene(client, thread, assistant, scene, file):
         thread_id=thread.id,
         role="user",
         content=prompt,
-        attachments=[{"file_id": file.id, "tools": [{"type": "file_search"}]}]
+        attachments=message_attachments(file)
     )
     
     # Create and monitor run
@@ -64,56 +150,109 @@ def process_single_scene(client, thread, assistant, scene, file):
     )
     
     start_time = time.time()
+    delays = poll_delays()
     while run.status != "completed":
-        if time.time() - start_time > 120:  # 2 minute timeout per scene
+        check_run_status(run, scene)
+        if time.time() - start_time > scene_timeout:  # 2 minute timeout per scene by default
             raise TimeoutError(f"Processing {scene['title']} timed out")
             
-        time.sleep(5)
-        print(f"Status for {scene['title']}: {run.status}")
+        time.sleep(next(delays))
         run = client.beta.threads.runs.retrieve(
             thread_id=thread.id,
             run_id=run.id
         )
     
+    metrics.record_span('scene_text.run', time.time() - start_time, scene['title'])
+    record_usage(run.usage)
+    
     # Get response
     messages = client.beta.threads.messages.list(thread_id=thread.id)
     response = messages.data[0].content[0].text.value
     print(f"Response for {scene['title']}: {response}")
     
-    try:
-        # Look for JSON between ```json and ``` markers
-        json_start = response.find("```json")
-        if json_start == -1:
-            # Try alternative format with '''json
-            json_start = response.find("'''json")
-            json_end = response.find("'''", json_start + 6) if json_start != -1 else -1
-        else:
-            json_end = response.find("```", json_start + 6)
-            
-        if json_start == -1 or json_end == -1:
-            raise ValueError(f"Could not find JSON content between markdown code blocks")
-            
-        # Extract just the JSON portion (skipping the markers)
-        json_content = response[json_start + 7:json_end].strip()
-        
-        # Parse the JSON
-        scene_data = json.loads(json_content)
-        
-        return scene_data
+    return parse_scene_response(response)
+
+async def process_single_scene_async(client, assistant, scene, file=None, scene_timeout=120):
+    """Async version of process_single_scene, runs the scene on its own thread"""
+    prompt = create_scene_text_prompt(scene)
+    print(f"\nProcessing {scene['title']} on page {scene['page_number']}")
+    
+    thread = await client.beta.threads.create()
+    await client.beta.threads.messages.create(
+        thread_id=thread.id,
+        role="user",
+        content=prompt,
+        attachments=message_attachments(file)
+    )
+    run = await client.beta.threads.runs.create(
+        thread_id=thread.id,
+        assistant_id=assistant.id
+    )
+    
+    start_time = time.monotonic()
+    delays = poll_delays()
+    while run.status != "completed":
+        check_run_status(run, scene)
+        if time.monotonic() - start_time > scene_timeout:
+            raise TimeoutError(f"Processing {scene['title']} timed out")
         
-    except json.JSONDecodeError as e:
-        print(f"JSON parsing error: {e}")
-        print("Raw JSON content:", json_content)
-        raise
+        await asyncio.sleep(next(delays))
+        run = await client.beta.threads.runs.retrieve(
+            thread_id=thread.id,
+            run_id=run.id
+        )
+    
+    metrics.record_span('scene_text.run', time.monotonic() - start_time, scene['title'])
+    record_usage(run.usage)
+    
+    messages = await client.beta.threads.messages.list(thread_id=thread.id)
+    response = messages.data[0].content[0].text.value
+    print(f"Response for {scene['title']}: {response}")
+    
+    return parse_scene_response(response)
 
-def fill_scene_text(pdf_path, scenes_path, output_path, timeout=300):
-    """Fill in text content for each scene using GPT-4"""
-    # Load initial scenes
-    with open(scenes_path, 'r') as f:
-        scenes = json.load(f)
-    import sys
+def process_scene_inline(client, scene, context, model="gpt-4o"):
+    """Process a single scene from its local text context with one chat completion, no file_search"""
+    prompt = create_scene_text_prompt(scene, context)
+    print(f"\nProcessing {scene['title']} on page {scene['page_number']} with local context")
     
-    # Get API key with better error handling
+    with metrics.span('scene_text.completion', label=scene['title']):
+        completion = client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}]
+        )
+    record_usage(completion.usage)
+    response = completion.choices[0].message.content
+    print(f"Response for {scene['title']}: {response}")
+    
+    return parse_scene_response(response)
+
+async def process_scene_inline_async(client, scene, context, model="gpt-4o"):
+    """Async version of process_scene_inline"""
+    prompt = create_scene_text_prompt(scene, context)
+    print(f"\nProcessing {scene['title']} on page {scene['page_number']} with local context")
+    
+    with metrics.span('scene_text.completion', label=scene['title']):
+        completion = await client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}]
+        )
+    record_usage(completion.usage)
+    response = completion.choices[0].message.content
+    print(f"Response for {scene['title']}: {response}")
+    
+    return parse_scene_response(response)
+
+def scene_cache_key(doc, scene, model, context=None, window=1):
+    """Key a scene on its prompt, the model and the content of the pages around it,
+    so editing an unrelated chapter does not invalidate it"""
+    page_num = int(scene['page_number'])
+    pages = range(max(0, page_num - window), min(len(doc), page_num + window + 1))
+    params = {'model': model, 'prompt': create_scene_text_prompt(scene, context)}
+    return make_key('scene_text', params, [page_content_hash(doc, n) for n in pages])
+
+def get_openai_api_key():
+    """Read OPENAI_API_KEY or exit with setup instructions"""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         print("Error: OPENAI_API_KEY environment variable is not set.")
@@ -121,67 +260,185 @@ def fill_scene_text(pdf_path, scenes_path, output_path, timeout=300):
         print("export OPENAI_API_KEY='your-api-key-here'  # For Unix/Mac")
         print("set OPENAI_API_KEY='your-api-key-here'     # For Windows")
         sys.exit(1)
+    return api_key
+
+def save_failed_scenes(failed_scenes):
+    with open('failed_scenes.json', 'w', encoding='utf-8') as f:
+        json.dump(failed_scenes, f, indent=4, ensure_ascii=False)
+
+def load_scenes(scenes):
+    """Accept either a path to a scenes JSON file or the scene list itself"""
+    if isinstance(scenes, (str, os.PathLike)):
+        with open(scenes, 'r') as f:
+            return json.load(f)
+    return list(scenes)
+
+def lookup_scene(scene, doc, model, cache=None, context_index=None):
+    """Return the scene's local context (None without elements), its cache key and the cached response,
+    None on a miss. Shared by the sync and async loops, which differ only in the client calls"""
+    context = context_index.scene_context(scene) if context_index else None
+    key = scene_cache_key(doc, scene, model, context) if cache else None
+    scene_data = cache.get_json(key) if cache else None
+    if scene_data is not None:
+        metrics.incr('scene_text.cache_hits')
+        print(f"Using cached text for {scene['title']}")
+    return context, key, scene_data
+
+def finish_scene(scene, scene_data, cache=None, key=None, fresh=True):
+    """Store a fresh response and set the scene's narration text"""
+    if cache and fresh:
+        cache.put_json(key, scene_data)
+    scene['text'] = scene_text_from_data(scene_data)
+    return scene
+
+def record_failure(failed_scenes, scene, error):
+    print(f"Error processing {scene['title']}: {error}")
+    failed_scenes.append({
+        'title': scene['title'],
+        'error': str(error)
+    })
+    
+    # Save error log
+    save_failed_scenes(failed_scenes)
+
+def report_results(processed_scenes, failed_scenes):
+    if failed_scenes:
+        print(f"\nWarning: {len(failed_scenes)} scenes failed to process.")
+        print("See failed_scenes.json for details")
+    
+    print(f"\nSuccessfully processed {len(processed_scenes)} scenes")
+
+def fill_scene_text(pdf_path, scenes_path, output_path, timeout=300, model="gpt-4o", cache=None,
+                    concurrency=1, base_url=None, elements=None, doc=None):
+    """Fill in text content for each scene using GPT-4.
+    concurrency > 1 runs scenes concurrently through fill_scene_text_async.
+    base_url points the client at another endpoint, e.g. a local stand-in for testing.
+    elements (from parse_textbook) switch to sending each scene's local text inline instead of file_search.
+    scenes_path may also be the scene list, output_path None skips the progress file, doc reuses an open document"""
+    if concurrency > 1:
+        return asyncio.run(fill_scene_text_async(pdf_path, scenes_path, output_path, concurrency=concurrency,
+                                                 model=model, cache=cache, base_url=base_url, elements=elements,
+                                                 doc=doc))
+    
+    # Load initial scenes
+    scenes = load_scenes(scenes_path)
+    
+    # Get API key with better error handling
+    api_key = get_openai_api_key()
         
     try:
-        client = OpenAI(api_key=api_key)
+        from openai import OpenAI  # Loaded on first use, importing this module stays cheap
+        client = OpenAI(api_key=api_key, base_url=base_url)
     except Exception as e:
         print(f"Error initializing OpenAI client: {e}")
         sys.exit(1)
     
-    # Create assistant with PDF file
-    file = client.files.create(
-        file=open(pdf_path, "rb"),
-        purpose='assistants'
-    )
+    cache = cache or default_cache()
+    doc = doc or fitz.open(pdf_path)
+    context_index = ContextIndex(elements) if elements is not None else None
+    registry = ResourceRegistry()
+    resources = {}
     
-    assistant = client.beta.assistants.create(
-        name="PDF Scene Text Assistant",
-        instructions="You will help identify relevant text sections for figures and tables in a PDF document.",
-        model="gpt-4o",
-        tools=[{"type": "file_search"}],
-    )
+    def get_assistant():
+        # Only touch the API once a scene actually misses the cache, and reuse the
+        # uploaded PDF, vector store and assistant registered by earlier runs
+        if not resources:
+            _, vector_store_id = ensure_pdf_resources(client, registry, pdf_path)
+            resources['assistant'] = ensure_assistant(client, registry, model, vector_store_id)
+        return resources['assistant']
     
     processed_scenes = []
     failed_scenes = []
     
     for scene in scenes:
         try:
-            # Create new thread for each scene
-            thread = client.beta.threads.create()
-            
-            # Process scene
-            scene_data = process_single_scene(client, thread, assistant, scene, file)
+            context, key, scene_data = lookup_scene(scene, doc, model, cache, context_index)
+            fresh = scene_data is None
+            if fresh and context is not None:
+                scene_data = process_scene_inline(client, scene, context, model)
+            elif fresh:
+                assistant = get_assistant()
+                
+                # Create new thread for each scene
+                thread = client.beta.threads.create()
+                
+                # Process scene
+                scene_data = process_single_scene(client, thread, assistant, scene)
             
             # Update scene with text
-            scene['text'] = (
-                clean_text(scene_data.get('pre_text', '')) + 
-                clean_text(scene_data.get('scene_text', '')) + 
-                clean_text(scene_data.get('post_text', ''))
-            )
-            processed_scenes.append(scene)
+            processed_scenes.append(finish_scene(scene, scene_data, cache, key, fresh))
             
             # Save progress after each successful scene
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(processed_scenes, f, indent=4, ensure_ascii=False)
+            if output_path:
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    json.dump(processed_scenes, f, indent=4, ensure_ascii=False)
                 
             print(f"Successfully processed {scene['title']}")
             
         except Exception as e:
-            print(f"Error processing {scene['title']}: {e}")
-            failed_scenes.append({
-                'title': scene['title'],
-                'error': str(e)
-            })
+            record_failure(failed_scenes, scene, e)
+    
+    report_results(processed_scenes, failed_scenes)
+    return processed_scenes
+
+async def fill_scene_text_async(pdf_path, scenes_path, output_path, concurrency=8, model="gpt-4o", cache=None,
+                                base_url=None, elements=None, doc=None):
+    """Fill in scene text with up to `concurrency` scenes in flight, keeping the original scene order in the output"""
+    scenes = load_scenes(scenes_path)
+    
+    from openai import AsyncOpenAI
+    client = AsyncOpenAI(api_key=get_openai_api_key(), base_url=base_url)
+    cache = cache or default_cache()
+    doc = doc or fitz.open(pdf_path)
+    context_index = ContextIndex(elements) if elements is not None else None
+    semaphore = asyncio.Semaphore(concurrency)
+    registry = ResourceRegistry()
+    resources = {}
+    resources_lock = asyncio.Lock()
+    
+    async def get_assistant():
+        # Resolve the registered (or freshly created) resources once, on the first cache miss
+        async with resources_lock:
+            if not resources:
+                _, vector_store_id = await ensure_pdf_resources_async(client, registry, pdf_path)
+                resources['assistant'] = await ensure_assistant_async(client, registry, model, vector_store_id)
+        return resources['assistant']
+    
+    results = [None] * len(scenes)
+    failed_scenes = []
+    
+    def save_progress():
+        if not output_path:
+            return
+        processed_scenes = [scene for scene in results if scene is not None]
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(processed_scenes, f, indent=4, ensure_ascii=False)
+    
+    async def run_scene(index, scene):
+        try:
+            context, key, scene_data = lookup_scene(scene, doc, model, cache, context_index)
+            fresh = scene_data is None
+            if fresh and context is not None:
+                async with semaphore:
+                    scene_data = await process_scene_inline_async(client, scene, context, model)
+            elif fresh:
+                assistant = await get_assistant()
+                async with semaphore:
+                    scene_data = await process_single_scene_async(client, assistant, scene)
             
-            # Save error log
-            with open('failed_scenes.json', 'w', encoding='utf-8') as f:
-                json.dump(failed_scenes, f, indent=4, ensure_ascii=False)
+            results[index] = finish_scene(scene, scene_data, cache, key, fresh)
+            save_progress()
+            print(f"Successfully processed {scene['title']}")
+        
+        except Exception as e:
+            record_failure(failed_scenes, scene, e)
     
-    if failed_scenes:
-        print(f"\nWarning: {len(failed_scenes)} scenes failed to process.")
-        print("See failed_scenes.json for details")
+    await asyncio.gather(*(run_scene(index, scene) for index, scene in enumerate(scenes)))
+    # Close the connections while this event loop is still running, the pipeline runs more loops after it
+    await client.close()
     
-    print(f"\nSuccessfully processed {len(processed_scenes)} scenes")
+    processed_scenes = [scene for scene in results if scene is not None]
+    report_results(processed_scenes, failed_scenes)
     return processed_scenes
 
 if __name__ == "__main__":
@@ -189,8 +446,16 @@ if __name__ == "__main__":
     scenes_path = "initial_scenes.json"
     output_path = "complete_scenes.json"
     
+    # Use parse_textbook output for local context when it is available, the columnar store loads fastest
+    elements = None
+    for elements_path in ("parsed_elements.npz", "parsed_elements.json"):
+        if os.path.exists(elements_path):
+            elements = load_elements(elements_path)
+            break
+    
     try:
-        fill_scene_text(pdf_path, scenes_path, output_path, timeout=600)  # 10 minute timeout
+        fill_scene_text(pdf_path, scenes_path, output_path, timeout=600,  # 10 minute timeout
+                        concurrency=int(os.getenv("SCENE_CONCURRENCY", "8")), elements=elements)
     except KeyboardInterrupt:
         print("\nScript interrupted by user")
         sys.exit(1)
@@ -0,0 +1,134 @@
+import atexit
+import cProfile
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# TEXTBOOK_METRICS=path exports on exit (.prom for a Prometheus textfile, anything else JSON).
+# TEXTBOOK_PROFILE=figures,equations (or 'all') runs those stage spans under cProfile.
+METRICS_PATH = os.getenv("TEXTBOOK_METRICS")
+PROFILE_STAGES = {name.strip() for name in os.getenv("TEXTBOOK_PROFILE", "").split(",") if name.strip()}
+PROFILE_DIR = os.getenv("TEXTBOOK_PROFILE_DIR", "profiles")
+
+class Metrics:
+    """Named spans (count, total and max seconds) and counters for one process.
+    Workers hand theirs to the parent with drain() and merge()"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+        # Forked workers start empty, otherwise they would send the parent's numbers back with drain()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(float)
+            self.spans = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record_span(self, name, seconds, label=None):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'max_label': None}
+            span['count'] += 1
+            span['seconds'] += seconds
+            if seconds >= span['max_seconds']:
+                span['max_seconds'] = seconds
+                span['max_label'] = label
+
+    @contextmanager
+    def span(self, name, label=None, profile=False):
+        """Time a block under name. label (e.g. a page number) is kept for the slowest occurrence.
+        profile=True runs the block under cProfile when the stage is listed in TEXTBOOK_PROFILE"""
+        profiler = None
+        if profile and (name in PROFILE_STAGES or 'all' in PROFILE_STAGES):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - start, label)
+            if profiler:
+                profiler.disable()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}.{os.getpid()}.prof"))
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': dict(self.counters), 'spans': {name: dict(span) for name, span in self.spans.items()}}
+
+    def drain(self):
+        """Snapshot and reset, for pool workers that return their metrics with each task"""
+        with self.lock:
+            snapshot = {'counters': dict(self.counters), 'spans': self.spans}
+            self.counters = defaultdict(float)
+            self.spans = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] += value
+            for name, other in snapshot['spans'].items():
+                span = self.spans.get(name)
+                if span is None:
+                    self.spans[name] = dict(other)
+                    continue
+                span['count'] += other['count']
+                span['seconds'] += other['seconds']
+                if other['max_seconds'] >= span['max_seconds']:
+                    span['max_seconds'] = other['max_seconds']
+                    span['max_label'] = other['max_label']
+
+    def to_prometheus(self, prefix="textbook"):
+        """Prometheus text exposition format"""
+        def metric_name(name):
+            return f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += [f"# TYPE {metric_name(name)}_total counter", f"{metric_name(name)}_total {value:g}"]
+        for stat, kind in (('count', 'counter'), ('seconds', 'counter'), ('max_seconds', 'gauge')):
+            lines.append(f"# TYPE {prefix}_span_{stat} {kind}")
+            for name, span in sorted(snapshot['spans'].items()):
+                lines.append(f'{prefix}_span_{stat}{{span="{name}"}} {span[stat]:g}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Write metrics to path, a Prometheus textfile for .prom and JSON otherwise"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=4)
+        os.replace(tmp_path, path)
+
+METRICS = Metrics()
+incr = METRICS.incr
+span = METRICS.span
+record_span = METRICS.record_span
+snapshot = METRICS.snapshot
+drain = METRICS.drain
+merge = METRICS.merge
+export = METRICS.export
+
+# Only the main process exports, workers send their metrics back with drain()
+if METRICS_PATH and multiprocessing.parent_process() is None:
+    atexit.register(export, METRICS_PATH)
@@ -0,0 +1,47 @@
+import hashlib
+import os
+import metrics
+from stage_cache import CACHE_ROOT, StageCache
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+class OCRCache:
+    """On-disk cache of tesseract output keyed by image content hash plus tesseract config"""
+
+    def __init__(self, cache_dir=os.path.join(CACHE_ROOT, "ocr"), max_bytes=DEFAULT_MAX_BYTES):
+        self.store = StageCache(cache_dir, max_bytes=max_bytes)
+
+    def key(self, image_path, lang=None, config=''):
+        """Hash the image bytes together with everything that changes tesseract's output"""
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(f"\0{lang}\0{config}".encode())
+        return digest.hexdigest()
+
+    def image_to_string(self, image_path, lang=None, config=''):
+        """Drop-in for pytesseract.image_to_string on an image file"""
+        key = self.key(image_path, lang, config)
+        cached = self.store.get_bytes(key)
+        if cached is not None:
+            metrics.incr('ocr.cache_hits')
+            return cached.decode('utf-8')
+
+        # pytesseract and PIL load on the first cache miss
+        import pytesseract
+        from PIL import Image
+        metrics.incr('ocr.calls')
+        with metrics.span('ocr'):
+            text = pytesseract.image_to_string(Image.open(image_path), lang=lang, config=config)
+        self.store.put_bytes(key, text.encode('utf-8'))
+        return text
+
+_default_cache = None
+
+def image_to_string(image_path, lang=None, config=''):
+    """OCR an image file through the shared default cache"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = OCRCache()
+    return _default_cache.image_to_string(image_path, lang=lang, config=config)
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import asyncio
+from contextlib import contextmanager
+from stage_cache import CACHE_ROOT, hash_file, hash_json
+
+REGISTRY_PATH = os.path.join(CACHE_ROOT, "openai_registry.json")
+
+ASSISTANT_CONFIG = {
+    'name': "PDF Scene Text Assistant",
+    'instructions': "You will help identify relevant text sections for figures and tables in a PDF document.",
+    'tools': [{"type": "file_search"}],
+}
+
+def poll_delays(initial=0.25, maximum=4.0):
+    """Short exponential backoff for polling instead of a fixed sleep"""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+class ResourceRegistry:
+    """Persistent map from PDF content hash and assistant config to OpenAI resource ids"""
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                self.data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.data = {}
+        self.data.setdefault('files', {})
+        self.data.setdefault('assistants', {})
+
+    def get(self, section, key):
+        return self.data[section].get(key)
+
+    def set(self, section, key, value):
+        self.data[section][key] = value
+        self.save()
+
+    def forget(self, section, key):
+        self.data[section].pop(key, None)
+        self.save()
+
+    def lookup_pdf(self, pdf_path):
+        """Return (pdf_hash, registered {'file_id', 'vector_store_id'} or None)"""
+        pdf_hash = hash_file(pdf_path)
+        return pdf_hash, self.get('files', pdf_hash)
+
+    def register_pdf(self, pdf_hash, file_id, vector_store_id):
+        self.set('files', pdf_hash, {'file_id': file_id, 'vector_store_id': vector_store_id})
+        return file_id, vector_store_id
+
+    def lookup_assistant(self, model, vector_store_id):
+        """Return (config, key, registered assistant id or None)"""
+        config = assistant_config(model, vector_store_id)
+        key = hash_json(config)
+        return config, key, self.get('assistants', key)
+
+    def register_assistant(self, key, assistant):
+        self.set('assistants', key, assistant.id)
+        return assistant
+
+    @contextmanager
+    def forget_if_missing(self, section, key):
+        """Drop an entry whose OpenAI resource was deleted, execution continues after the block to recreate it"""
+        from openai import NotFoundError  # The caller's client has already loaded openai
+        try:
+            yield
+        except NotFoundError:
+            self.forget(section, key)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+def assistant_config(model, vector_store_id):
+    return dict(ASSISTANT_CONFIG, model=model,
+                tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}})
+
+def vector_store_name(pdf_hash):
+    return f"textbook-{pdf_hash[:12]}"
+
+# The sync and async versions share the registry logic above and differ only in the client calls
+
+def ensure_pdf_resources(client, registry, pdf_path):
+    """Return (file_id, vector_store_id) for the PDF, uploading and indexing only if it is not registered yet"""
+    pdf_hash, entry = registry.lookup_pdf(pdf_path)
+    if entry:
+        with registry.forget_if_missing('files', pdf_hash):
+            client.vector_stores.retrieve(entry['vector_store_id'])
+            return entry['file_id'], entry['vector_store_id']
+
+    with open(pdf_path, "rb") as pdf_file:
+        file = client.files.create(file=pdf_file, purpose='assistants')
+    vector_store = client.vector_stores.create(name=vector_store_name(pdf_hash), file_ids=[file.id])
+    delays = poll_delays()
+    while vector_store.status == "in_progress":
+        time.sleep(next(delays))
+        vector_store = client.vector_stores.retrieve(vector_store.id)
+    return registry.register_pdf(pdf_hash, file.id, vector_store.id)
+
+def ensure_assistant(client, registry, model, vector_store_id):
+    """Return the assistant for this config, creating it only if it is not registered yet"""
+    config, key, assistant_id = registry.lookup_assistant(model, vector_store_id)
+    if assistant_id:
+        with registry.forget_if_missing('assistants', key):
+            return client.beta.assistants.retrieve(assistant_id)
+    return registry.register_assistant(key, client.beta.assistants.create(**config))
+
+async def ensure_pdf_resources_async(client, registry, pdf_path):
+    """Async version of ensure_pdf_resources"""
+    pdf_hash, entry = registry.lookup_pdf(pdf_path)
+    if entry:
+        with registry.forget_if_missing('files', pdf_hash):
+            await client.vector_stores.retrieve(entry['vector_store_id'])
+            return entry['file_id'], entry['vector_store_id']
+
+    with open(pdf_path, "rb") as pdf_file:
+        file = await client.files.create(file=pdf_file, purpose='assistants')
+    vector_store = await client.vector_stores.create(name=vector_store_name(pdf_hash), file_ids=[file.id])
+    delays = poll_delays()
+    while vector_store.status == "in_progress":
+        await asyncio.sleep(next(delays))
+        vector_store = await client.vector_stores.retrieve(vector_store.id)
+    return registry.register_pdf(pdf_hash, file.id, vector_store.id)
+
+async def ensure_assistant_async(client, registry, model, vector_store_id):
+    """Async version of ensure_assistant"""
+    config, key, assistant_id = registry.lookup_assistant(model, vector_store_id)
+    if assistant_id:
+        with registry.forget_if_missing('assistants', key):
+            return await client.beta.assistants.retrieve(assistant_id)
+    return registry.register_assistant(key, await client.beta.assistants.create(**config))
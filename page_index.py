@@ -0,0 +1,78 @@
+import os
+import re
+import fitz
+import metrics
+from parse_textbook import FIGURE_TABLE_TITLE, MATH_SYMBOLS
+
+# Font names used for math typesetting (TeX Computer Modern and AMS, STIX, Symbol, Cambria Math, ...)
+MATH_FONT = re.compile(r'math|cmmi|cmsy|cmex|msam|msbm|stix|symbol|euclid|mtextra', re.IGNORECASE)
+def figure_min_area():
+    """FIGURE_PARAMS['min_area'] in square points: smaller images and drawings can't become a figure crop"""
+    from pdfFigureExtract import FIGURE_PARAMS  # Imported here, pdfFigureExtract imports this module
+    return FIGURE_PARAMS['min_area'] / FIGURE_PARAMS['zoom'] ** 2
+
+def is_large(rect, min_area):
+    rect = fitz.Rect(rect)
+    return rect.width * rect.height >= min_area
+
+def has_caption(text):
+    return any(FIGURE_TABLE_TITLE.match(line.strip().lower()) for line in text.splitlines())
+
+def may_have_figures(page, text=None, min_area=None):
+    """A large image, a large group of vector drawings (axes, bars, table rules) or a figure/table caption.
+    Cheapest checks first, nothing is rendered"""
+    if min_area is None:
+        min_area = figure_min_area()
+    if any(is_large(info['bbox'], min_area) for info in page.get_image_info()):
+        return True
+    # get_cdrawings is the fast emptiness check, clustering (nearby paths as one rect) only runs if needed
+    if page.get_cdrawings() and any(is_large(rect, min_area) for rect in page.cluster_drawings()):
+        return True
+    return has_caption(page.get_text() if text is None else text)
+
+def may_have_equations(page, text=None):
+    """A math font or math symbol, or no text layer at all (left to raster detection)"""
+    if any(MATH_FONT.search(font[3]) for font in page.get_fonts()):
+        return True
+    text = page.get_text() if text is None else text
+    return not text.strip() or not MATH_SYMBOLS.isdisjoint(text)
+
+PAGE_TESTS = {'figure': may_have_figures, 'equation': may_have_equations}
+
+class PageIndex:
+    """Per-book index of the pages likely to hold figures/tables or display equations,
+    so the extractors only render and analyze those"""
+
+    def __init__(self, doc, kinds=('figure', 'equation')):
+        # Accept either a path or an already open document
+        if isinstance(doc, (str, os.PathLike)):
+            doc = fitz.open(doc)
+        self.page_count = len(doc)
+        self.pages = {kind: [] for kind in kinds}
+        with metrics.span('page_index'):
+            for page in doc:
+                # Every kind ends up reading the text of a plain prose page, so read it once
+                text = page.get_text() if len(kinds) > 1 else None
+                for kind in kinds:
+                    if PAGE_TESTS[kind](page, text):
+                        self.pages[kind].append(page.number)
+
+    def __len__(self):
+        return self.page_count
+
+    @property
+    def figure_pages(self):
+        return self.pages['figure']
+
+    @property
+    def equation_pages(self):
+        return self.pages['equation']
+
+def select_pages(doc, pages=None, full_scan=False, kind='figure'):
+    """Page numbers an extractor should analyze: the given list, every page with full_scan,
+    otherwise the pages the index flags for kind ('figure' or 'equation')"""
+    if pages is not None:
+        return list(pages)
+    if full_scan:
+        return list(range(len(doc)))
+    return PageIndex(doc, kinds=(kind,)).pages[kind]
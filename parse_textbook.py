@@ -1,13 +1,23 @@
 import fitz
 import json
-from pathlib import Path
+import os
+from concurrent.futures import ProcessPoolExecutor
 import re
+from element_store import ElementStore
+import metrics
+from pdf_pages import split_pages
+from stage_cache import default_cache, make_key, page_content_hash
+
+# Compiled once instead of per block
+FIGURE_TABLE_TITLE = re.compile(r'^(figure|table)\s+\d+')  # Matched against lowercased text
+NEW_FIGURE_TABLE = re.compile(r'^(Figure|Table)\s+\d+')
+MATH_SYMBOLS = frozenset('∑∫=≠≈≤≥±→←↔')
 
 def identify_element_type(text, page_num, y_pos, bottom_y):
     """Identify if text block is a figure/table title, equation, or paragraph"""
     text = text.strip()
     # Check for figure/table titles (case insensitive)
-    if re.match(r'^(figure|table)\s+\d+', text.lower()):
+    if FIGURE_TABLE_TITLE.match(text.lower()):
         return {
             'type': 'figure_table',
             'title': text,
@@ -17,7 +27,7 @@ def identify_element_type(text, page_num, y_pos, bottom_y):
             'bottom_y': bottom_y
         }
     # Check for equations (look for mathematical symbols)
-    elif any(char in text for char in '∑∫=≠≈≤≥±→←↔') and len(text) < 100:
+    elif len(text) < 100 and not MATH_SYMBOLS.isdisjoint(text):
         return {
             'type': 'equation',
             'text': text,
@@ -38,7 +48,10 @@ def identify_element_type(text, page_num, y_pos, bottom_y):
 
 def merge_paragraph_blocks(blocks):
     """Merge text blocks that belong to the same paragraph"""
-    merged_blocks = []
+    return list(iter_merged_blocks(blocks))
+
+def iter_merged_blocks(blocks):
+    """Yield merged paragraph blocks as soon as each paragraph is complete"""
     current_paragraph = []
     
     for block in blocks:
@@ -61,76 +74,135 @@ def merge_paragraph_blocks(blocks):
         
         if (abs(y0 - prev_y1) < vertical_margin or  # Same line
             (y0 - prev_y1 < line_spacing and  # Next line with reasonable spacing
-             not re.match(r'^(Figure|Table)\s+\d+', text.strip()))):  # Not a new figure/table reference
+             not NEW_FIGURE_TABLE.match(text.strip()))):  # Not a new figure/table reference
             current_paragraph.append(block)
         else:
             # Merge current paragraph blocks and start new paragraph
             merged_text = ' '.join(b[4] for b in current_paragraph)
-            merged_blocks.append((
+            yield (
                 current_paragraph[0][0],  # x0 from first block
                 current_paragraph[0][1],  # y0 from first block
                 current_paragraph[-1][2], # x1 from last block
                 current_paragraph[-1][3], # y1 from last block
                 merged_text
-            ))
+            )
             current_paragraph = [block]
     
     # Don't forget to merge the last paragraph
     if current_paragraph:
         merged_text = ' '.join(b[4] for b in current_paragraph)
-        merged_blocks.append((
+        yield (
             current_paragraph[0][0],
             current_paragraph[0][1],
             current_paragraph[-1][2],
             current_paragraph[-1][3],
             merged_text
-        ))
+        )
+
+def parse_page_elements(page, page_num, header_margin=100, footer_margin=200):
+    """Yield the elements of a single page in reading order.
+    header_margin and footer_margin: adjust based on your PDF"""
+    blocks = page.get_text("blocks")
+    
+    # Get page dimensions
+    page_height = page.rect.height
+    # print(f"Page height: {page_height}")
+    
+    # Filter out header/footer blocks
+    content_blocks = [b for b in blocks if header_margin < b[1] < (page_height - footer_margin)]
     
-    return merged_blocks
+    # Sort blocks by vertical position
+    content_blocks.sort(key=lambda b: (b[1], b[0]))  # Sort by y, then x
+    
+    # Merge, filter and classify in one pass over the sorted blocks
+    footnote_y = page_height - footer_margin
+    for block in iter_merged_blocks(content_blocks):
+        if block[3] > footnote_y and block[3] - block[1] < 350: # Ignore footnotes
+            continue
+        text = block[4]
+        # Remove special characters while preserving basic punctuation and spaces
+        if not text.isprintable():
+            text = ''.join(char for char in text if char.isprintable())
+        if text.strip():  # Skip empty blocks
+            yield identify_element_type(text, page_num + 1, block[1], block[3])  # Pass y position and bottom y
+
+def parse_page_cached(doc, page_num, cache=None, header_margin=100, footer_margin=200):
+    """Elements of one page as a list, reused from the stage cache when the page content is unchanged"""
+    with metrics.span('parse.page', label=page_num):
+        if cache is None:
+            return list(parse_page_elements(doc[page_num], page_num, header_margin, footer_margin))
+        
+        params = {'page_num': page_num, 'header_margin': header_margin, 'footer_margin': footer_margin}
+        key = make_key('parse_page', params, [page_content_hash(doc, page_num)])
+        elements = cache.get_json(key)
+        if elements is None:
+            elements = list(parse_page_elements(doc[page_num], page_num, header_margin, footer_margin))
+            cache.put_json(key, elements)
+        return elements
 
-def parse_pdf_content(pdf_path):
-    """Extract all elements from PDF in sequential order"""
+def _parse_pages(pdf_path, page_numbers, cache=None, header_margin=100, footer_margin=200):
+    """Worker entry point: opens its own document and parses a chunk of pages.
+    Returns the page elements and the worker's metrics for the parent to merge"""
     doc = fitz.open(pdf_path)
-    elements = []
+    results = [parse_page_cached(doc, page_num, cache, header_margin, footer_margin) for page_num in page_numbers]
+    return results, metrics.drain()
+
+def iter_pdf_content(pdf_path, cache=None, header_margin=100, footer_margin=200, workers=1):
+    """Yield elements page by page so downstream stages can start before the whole book is parsed.
+    Pages whose content hash is already in the stage cache are not re-parsed.
+    workers > 1 parses contiguous page ranges in separate processes, the output is identical.
+    Accepts either a path or an already open document"""
+    doc = pdf_path if isinstance(pdf_path, fitz.Document) else fitz.open(pdf_path)
+    cache = cache or default_cache()
+    if workers <= 1:
+        for page_num in range(len(doc)):
+            yield from parse_page_cached(doc, page_num, cache, header_margin, footer_margin)
+        return
     
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        blocks = page.get_text("blocks")
-        
-        # Get page dimensions
-        page_height = page.rect.height
-        # print(f"Page height: {page_height}")
-        header_margin = 100  # Adjust based on your PDF
-        footer_margin = 200  # Adjust based on your PDF
-        
-        # Filter out header/footer blocks
-        content_blocks = [b for b in blocks if header_margin < b[1] < (page_height - footer_margin)]
-        
-        # Sort blocks by vertical position
-        content_blocks.sort(key=lambda b: (b[1], b[0]))  # Sort by y, then x
-        
-        # Merge paragraph blocks
-        merged_blocks = merge_paragraph_blocks(content_blocks)
-        
-        for block in merged_blocks:
-            if block[3] > page_height - footer_margin and block[3] - block[1] < 350: # Ignore footnotes
-                print(f"Skipping footnote found on page number: {page_num + 1}")
-                print(f"    >>>Block bottom y: {block[3]}, Page height: {page_height}, Block height: {block[3] - block[1]}")
-                print(f"    >>>text: {block[4]}")
-                continue
-            text = block[4]
-            # Remove special characters while preserving basic punctuation and spaces
-            text = ''.join(char for char in text if char.isprintable())
-            if text.strip():  # Skip empty blocks
-                element = identify_element_type(text, page_num + 1, block[1], block[3])  # Pass y position and bottom y
-                elements.append(element)
+    # Chunks come back in page order, each one is yielded as soon as it and all earlier chunks are done
+    chunks = split_pages(range(len(doc)), workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_parse_pages, doc.name, chunk, cache, header_margin, footer_margin)
+                   for chunk in chunks]
+        for future in futures:
+            results, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            for elements in results:
+                yield from elements
+
+def write_elements_jsonl(elements, output_path):
+    """Stream elements to a JSONL file, one element per line, returns the number written"""
+    count = 0
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for element in elements:
+            f.write(json.dumps(element, ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
+
+def read_elements_jsonl(input_path):
+    """Lazily yield elements back from a JSONL file"""
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def parse_pdf_content(pdf_path, output_path='parsed_elements.json', cache=None, workers=1, columnar_path=None):
+    """Extract all elements from PDF in sequential order.
+    columnar_path also saves them as an ElementStore .npz for the later stages"""
+    with metrics.span('parse', profile=True):
+        elements = list(iter_pdf_content(pdf_path, cache=cache, workers=workers))
+    metrics.incr('parse.elements', len(elements))
 
     print(f"Parsed {len(elements)} elements from PDF")
     #save to json file 
-    with open('parsed_elements.json', 'w') as f:
+    with open(output_path, 'w') as f:
         json.dump(elements, f, indent=4, ensure_ascii=False)
+    metrics.incr('bytes_written', os.path.getsize(output_path))
+    if columnar_path:
+        ElementStore(elements).save(columnar_path)
     
     return elements
 
 if __name__ == "__main__":
-    parse_pdf_content("macro.pdf")
\ No newline at end of file
+    parse_pdf_content("macro.pdf", workers=os.cpu_count())
\ No newline at end of file
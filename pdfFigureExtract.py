@@ -1,16 +1,86 @@
 import os
+import re
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 import fitz
-import cv2
-import pytesseract
-from PIL import Image
+import numpy as np
+import metrics
+import ocr_cache
+from page_index import select_pages
+from pdf_pages import PageCache, split_pages
+from stage_cache import cached_page_outputs, default_cache, make_key, page_content_hash
+
+# Detection settings, read by the detector and part of the stage cache key for every page.
+# margins: (initial margin, x step, y step) in pixels, full_width: crops wider than this share of the page span it
+FIGURE_PARAMS = {'zoom': 1, 'threshold': 200, 'min_area': 10000, 'aspect_ratio': (0.5, 2.5), 'overlap': 0.7,
+                 'margins': (240, 50, 200), 'full_width': 0.5}
+# Bump when the detection code changes, so cached crops from the old code are not reused
+FIGURES_VERSION = 1
 
 def contains_figure_or_table(image_path):
-    # Read text from image using OCR
-    text = pytesseract.image_to_string(Image.open(image_path)).lower()
+    # Read text from image using OCR (cached by image content)
+    text = ocr_cache.image_to_string(image_path).lower()
     return 'figure' in text or 'table' in text
 
-def extract_region_with_adaptive_margins(image, base_x, base_y, base_w, base_h, margin_x, margin_y):
+def find_caption_rects(page, zoom=1):
+    """Locate 'Figure N' / 'Table N' labels from the text layer, in pixel coordinates of a zoom render.
+    Returns None when the page has no text layer (e.g. scanned pages)"""
+    words = page.get_text("words")  # (x0, y0, x1, y1, word, block_no, line_no, word_no)
+    if not words:
+        return None
+    
+    matrix = page.rotation_matrix * fitz.Matrix(zoom, zoom)
+    caption_rects = []
+    for word, next_word in zip(words, words[1:]):
+        # A caption label starts its line and is followed by a number on the same line
+        if (word[7] == 0 and next_word[5:7] == word[5:7] and
+                re.match(r'^(figure|table)$', word[4].lower()) and re.match(r'^\d', next_word[4])):
+            caption_rects.append((fitz.Rect(word[:4]) | fitz.Rect(next_word[:4])) * matrix)
+    return caption_rects
+
+def crop_contains_rect(crop, rect):
+    x_crop, y_crop, w_crop, h_crop = crop
+    return (x_crop <= rect.x0 and rect.x1 <= x_crop + w_crop and
+            y_crop <= rect.y0 and rect.y1 <= y_crop + h_crop)
+
+def save_crop(image, crop, image_path):
+    import cv2
+    x_crop, y_crop, w_crop, h_crop = crop
+    cropped_image = image[y_crop:y_crop+h_crop, x_crop:x_crop+w_crop]
+    cv2.imwrite(image_path, cv2.cvtColor(cropped_image, cv2.COLOR_RGB2BGR))
+
+def crop_contains_caption_ocr(image, crop, image_path):
+    """OCR fallback: write the crop and look for figure/table text, removing the file on a miss"""
+    save_crop(image, crop, image_path)
+    if contains_figure_or_table(image_path):
+        return True
+    os.remove(image_path)  # Remove the temporary file if no figure/table found
+    return False
+
+def grow_margins_until_caption(image, box, has_caption, margins=FIGURE_PARAMS['margins'],
+                               full_width=FIGURE_PARAMS['full_width']):
+    """Grow the crop margins around box until has_caption(crop) holds.
+    Returns the crop, or None once the crop covers the whole page without a caption"""
+    x, y, w, h = box
+    height, width = image.shape[:2]
+    
+    # Start with initial margins
+    initial, step_x, step_y = margins
+    margin_x = initial
+    margin_y = initial
+    while True:
+        crop = extract_region_with_adaptive_margins(image, x, y, w, h, margin_x, margin_y, full_width)
+        if has_caption(crop):
+            return crop
+        
+        x_crop, y_crop, w_crop, h_crop = crop
+        if x_crop == 0 and y_crop == 0 and w_crop >= width and h_crop >= height:
+            return None
+        margin_x += step_x
+        margin_y += step_y
+
+def extract_region_with_adaptive_margins(image, base_x, base_y, base_w, base_h, margin_x, margin_y,
+                                         full_width=FIGURE_PARAMS['full_width']):
     height, width = image.shape[:2]
     
     # Calculate coordinates with current margins
@@ -20,13 +90,13 @@ def extract_region_with_adaptive_margins(image, base_x, base_y, base_w, base_h,
     h = min(base_h + 2 * margin_y, height - y)
     
     # If width is more than half the page, use full width
-    if w > 0.5 * width:
+    if w > full_width * width:
         x = 0
         w = width
         
     return x, y, w, h
 
-def calculate_iou(box1, box2):
+def calculate_iou(box1, box2, threshold=FIGURE_PARAMS['overlap']):
     # box format: (x, y, w, h)
     x1, y1, w1, h1 = box1
     x2, y2, w2, h2 = box2
@@ -46,91 +116,146 @@ def calculate_iou(box1, box2):
     box2_area = w2 * h2
     
     # if we intersect more than 70% of one of the boxes, we consider it a match
-    if intersection_area / box1_area > 0.7 or intersection_area / box2_area > 0.7:
+    if intersection_area / box1_area > threshold or intersection_area / box2_area > threshold:
         return 1.0
+    return 0.0
+
+def candidate_boxes(contours, min_area=FIGURE_PARAMS['min_area'], min_aspect=FIGURE_PARAMS['aspect_ratio'][0],
+                    max_aspect=FIGURE_PARAMS['aspect_ratio'][1]):
+    """Bounding boxes (N, 4) of figure-sized contours and their contour indices, filtered in one vectorized step"""
+    if not contours:
+        return np.empty((0, 4), dtype=np.int64), np.empty(0, dtype=np.int64)
+    
+    import cv2
+    boxes = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int64)
+    w = boxes[:, 2]
+    h = boxes[:, 3]
+    aspect_ratio = np.divide(w, h, out=np.zeros(len(boxes)), where=h > 0)
+    keep = (w * h > min_area) & (aspect_ratio > min_aspect) & (aspect_ratio < max_aspect)
+    indices = np.flatnonzero(keep)
+    return boxes[indices], indices
 
-def process_pdf_with_extra_large_margins(pdf_path, output_directory):
-    doc = fitz.open(pdf_path)
+def overlap_matrix(boxes, threshold=FIGURE_PARAMS['overlap']):
+    """Pairwise version of calculate_iou: True where two boxes share more than threshold of either box's area"""
+    x, y, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    inter_w = np.minimum(x + w, (x + w)[:, None]) - np.maximum(x, x[:, None])
+    inter_h = np.minimum(y + h, (y + h)[:, None]) - np.maximum(y, y[:, None])
+    intersection = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+    area = w * h
+    return (intersection > threshold * area[:, None]) | (intersection > threshold * area[None, :])
+
+def detect_figures_on_page(page_cache, page_num, output_directory, params=FIGURE_PARAMS):
+    """Detect figure/table crops on one page with the given settings, returns (extracted_files, page_boxes)"""
+    import cv2  # Loaded on first use, importing this module stays cheap
     extracted_files = []
-    saved_boxes = []  # List to store saved bounding boxes per page
+    page_boxes = []  # Store boxes for current page
+    # Render the page straight into memory (RGB)
+    image = page_cache.get(page_num, zoom=params['zoom'])
+    caption_rects = find_caption_rects(page_cache.doc.load_page(page_num), zoom=params['zoom'])
+    height, width = image.shape[:2]
     
-    for page_num in range(len(doc)):
-        page_boxes = []  # Store boxes for current page
-        # Render the page as an image
-        pixmap = doc.load_page(page_num).get_pixmap()
-        image_path = os.path.join(output_directory, f'page_{page_num}.png')
-        pixmap.save(image_path)
-        
-        # Reload the saved image with OpenCV
-        image = cv2.imread(image_path)
-        height, width = image.shape[:2]
-        
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Convert to grayscale
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    
+    # Threshold and detect contours
+    _, thresh = cv2.threshold(gray, params['threshold'], 255, cv2.THRESH_BINARY_INV)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    
+    # Filter all contours at once, then suppress candidates overlapping an already saved box
+    boxes, indices = candidate_boxes(contours, params['min_area'], *params['aspect_ratio'])
+    metrics.incr('figures.candidates', len(boxes))
+    overlaps = overlap_matrix(boxes, params['overlap'])
+    saved = np.zeros(len(boxes), dtype=bool)
+    
+    for k, i in enumerate(indices):
+        if (overlaps[k] & saved).any():
+            continue
+        current_box = tuple(int(v) for v in boxes[k])
         
-        # Threshold and detect contours
-        _, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cropped_image_path = os.path.join(output_directory, f'figure_page{page_num}_{i}.png')
+        if caption_rects is not None:
+            # Captions come from the text layer, so growing the crop needs no OCR
+            crop = grow_margins_until_caption(
+                image, current_box, lambda crop: any(crop_contains_rect(crop, rect) for rect in caption_rects),
+                params['margins'], params['full_width'])
+            if crop is not None:
+                save_crop(image, crop, cropped_image_path)
+        else:
+            # No text layer on this page, fall back to OCR on every grown crop
+            crop = grow_margins_until_caption(
+                image, current_box, lambda crop: crop_contains_caption_ocr(image, crop, cropped_image_path),
+                params['margins'], params['full_width'])
         
-        for i, contour in enumerate(contours):
-            x, y, w, h = cv2.boundingRect(contour)
-            area = w * h
-            aspect_ratio = w / h if h > 0 else 0
-            
-            if area > 10000 and 0.5 < aspect_ratio < 2.5:
-                # Check for overlap with existing boxes
-                current_box = (x, y, w, h)
-                overlap_found = False
-                
-                for saved_box in page_boxes:
-                    iou = calculate_iou(current_box, saved_box)
-                    print(f"    iou: {iou}")
-                    if iou > 0.7:  # 80% overlap threshold
-                        overlap_found = True
-                        break
-                
-                if overlap_found:
-                    continue
-                
-                # Start with initial margins
-                margin_x = 240
-                margin_y = 240
-                found_text = False
-                
-                # Keep trying with larger margins until we find the text or reach page limits
-                while not found_text:
-                    x_crop, y_crop, w_crop, h_crop = extract_region_with_adaptive_margins(image, x, y, w, h, margin_x, margin_y)
-                    print(f"image {page_num}_{i}: x_crop: {x_crop} y_crop: {y_crop} w_crop: {w_crop} h_crop: {h_crop}")
-                    cropped_image = image[y_crop:y_crop+h_crop, x_crop:x_crop+w_crop]
-                    cropped_image_path = os.path.join(output_directory, f'figure_page{page_num}_{i}.png')
-                    cv2.imwrite(cropped_image_path, cropped_image)
-                    
-                    found_text = contains_figure_or_table(cropped_image_path)
-                    
-                    if found_text:
-                        extracted_files.append(cropped_image_path)
-                        page_boxes.append(current_box)  # Save the box if we found a figure/table
-                        # print("SAVED FILE", cropped_image_path)
-                    elif not found_text:
-                        margin_x += 50
-                        margin_y += 200
-                        # print("REMOVE TEMP FILE", cropped_image_path)
-                        os.remove(cropped_image_path)  # Remove the temporary file if no figure/table found
-        print(f" Page boxes: {page_boxes}")
+        if crop is not None:
+            metrics.incr('figures.crops')
+            metrics.incr('bytes_written', os.path.getsize(cropped_image_path))
+            extracted_files.append(cropped_image_path)
+            page_boxes.append(current_box)  # Save the box if we found a figure/table
+            saved[k] = True
+    return extracted_files, page_boxes
+
+def extract_figures_from_page(page_cache, page_num, output_directory, cache=None):
+    """Figure crops for one page, restored from the stage cache when the page content is unchanged"""
+    with metrics.span('figures.page', label=page_num):
+        if cache is None:
+            return detect_figures_on_page(page_cache, page_num, output_directory)
+        key = make_key('figures', dict(FIGURE_PARAMS, version=FIGURES_VERSION, page_num=page_num),
+                       [page_content_hash(page_cache.doc, page_num)])
+        return cached_page_outputs(cache, key, output_directory,
+                                   lambda: detect_figures_on_page(page_cache, page_num, output_directory))
+
+def _extract_figures_from_pages(pdf_path, output_directory, page_numbers, cache=None):
+    """Worker entry point: opens its own document and processes a chunk of pages.
+    Returns the page results and the worker's metrics for the parent to merge"""
+    page_cache = PageCache(pdf_path, max_pages=1)
+    results = [extract_figures_from_page(page_cache, page_num, output_directory, cache) for page_num in page_numbers]
+    return results, metrics.drain()
+
+def process_pdf_with_extra_large_margins(pdf_path, output_directory, page_cache=None, workers=1, cache=None,
+                                         pages=None, full_scan=False):
+    """Only pages the PageIndex flags for figures are rendered, unless pages lists them or full_scan is set"""
+    with metrics.span('figures', profile=True):
+        return _process_pdf_figures(pdf_path, output_directory, page_cache, workers, cache, pages, full_scan)
+
+def _process_pdf_figures(pdf_path, output_directory, page_cache, workers, cache, pages=None, full_scan=False):
+    if page_cache is None:
+        page_cache = PageCache(pdf_path)
+    cache = cache or default_cache()
+    page_numbers = select_pages(page_cache.doc, pages, full_scan, kind='figure')
+    metrics.incr('figures.pages_skipped', len(page_cache.doc) - len(page_numbers))
+    
+    if workers > 1 and page_numbers:
+        # Each worker opens its own fitz document, results come back in page order
+        chunks = split_pages(page_numbers, workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_extract_figures_from_pages, pdf_path, output_directory, chunk, cache)
+                       for chunk in chunks]
+            page_results = []
+            for future in futures:
+                results, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                page_results.extend(results)
+    else:
+        page_results = [extract_figures_from_page(page_cache, page_num, output_directory, cache)
+                        for page_num in page_numbers]
+    
+    extracted_files = []
+    saved_boxes = []  # List to store saved bounding boxes per page
+    for page_files, page_boxes in page_results:
+        extracted_files.extend(page_files)
         saved_boxes.append(page_boxes)  # Save boxes for this page
     
     return extracted_files
 
-# Create a directory for extra large margin output
-output_dir_extra_large_margin = './extracted_figures_extra_large_margin'
-os.makedirs(output_dir_extra_large_margin, exist_ok=True)
-
-
-# Reprocess the PDF with extra large margins
-extra_large_margin_results = process_pdf_with_extra_large_margins("macro.pdf", output_dir_extra_large_margin)
+if __name__ == "__main__":
+    # Create a directory for extra large margin output
+    output_dir_extra_large_margin = './extracted_figures_extra_large_margin'
+    os.makedirs(output_dir_extra_large_margin, exist_ok=True)
 
-# Create a zip file for the extra large margin extracted figures
-zip_file_extra_large_margin = './extracted_figures_extra_large_margin.zip'
-shutil.make_archive(zip_file_extra_large_margin.replace('.zip', ''), 'zip', output_dir_extra_large_margin)
+    # Reprocess the PDF with extra large margins
+    extra_large_margin_results = process_pdf_with_extra_large_margins(
+        "macro.pdf", output_dir_extra_large_margin, workers=os.cpu_count())
 
-zip_file_extra_large_margin
\ No newline at end of file
+    # Create a zip file for the extra large margin extracted figures
+    zip_file_extra_large_margin = './extracted_figures_extra_large_margin.zip'
+    shutil.make_archive(zip_file_extra_large_margin.replace('.zip', ''), 'zip', output_dir_extra_large_margin)
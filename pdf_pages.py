@@ -0,0 +1,73 @@
+import os
+from collections import OrderedDict
+import fitz
+import numpy as np
+import metrics
+
+class PageImage(np.ndarray):
+    """NumPy view over a pixmap's samples that keeps the pixmap alive"""
+    pixmap = None
+
+def pixmap_to_array(pixmap):
+    """Wrap a pixmap's sample buffer as an (height, width, channels) uint8 array without copying"""
+    image = np.ndarray(
+        (pixmap.height, pixmap.width, pixmap.n),
+        dtype=np.uint8,
+        buffer=pixmap.samples_mv,
+        strides=(pixmap.stride, pixmap.n, 1)
+    ).view(PageImage)
+    # The memoryview does not reference the pixmap, so the array has to
+    image.pixmap = pixmap
+    return image
+
+def render_page(doc, page_num, zoom=1):
+    """Render a page to an RGB array, zoom=1 matches the default get_pixmap() matrix"""
+    matrix = fitz.Identity if zoom == 1 else fitz.Matrix(zoom, zoom)
+    pixmap = doc.load_page(page_num).get_pixmap(matrix=matrix)
+    metrics.incr('pages_rendered')
+    return pixmap_to_array(pixmap)
+
+class PageCache:
+    """LRU cache of rendered pages keyed by (page number, zoom)"""
+
+    def __init__(self, doc, max_pages=8):
+        # Accept either a path or an already open document
+        if isinstance(doc, (str, os.PathLike)):
+            doc = fitz.open(doc)
+        self.doc = doc
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, page_num, zoom=1):
+        """Return the RGB array for a page, rendering it on a miss"""
+        key = (page_num, zoom)
+        if key in self._pages:
+            self._pages.move_to_end(key)
+            return self._pages[key]
+
+        image = render_page(self.doc, page_num, zoom)
+        self._pages[key] = image
+        # Evict least recently used pages beyond the bound
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return image
+
+    def clear(self):
+        self._pages.clear()
+
+def split_pages(page_numbers, workers, chunks_per_worker=4):
+    """Split page numbers into contiguous chunks, several per worker so slow pages balance out"""
+    page_numbers = list(page_numbers)
+    n_chunks = max(1, min(len(page_numbers), workers * chunks_per_worker))
+    size, extra = divmod(len(page_numbers), n_chunks)
+    chunks = []
+    start = 0
+    for i in range(n_chunks):
+        stop = start + size + (1 if i < extra else 0)
+        if stop > start:
+            chunks.append(page_numbers[start:stop])
+        start = stop
+    return chunks
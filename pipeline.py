@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+import fitz
+import metrics
+from associate_content import associate_store
+from create_scenes import create_initial_scenes, save_scenes
+from create_video import create_video
+from element_store import ElementStore
+from equationExtract import process_pdf_for_equations
+from fill_scene_text import fill_scene_text
+from page_index import PageIndex
+from parse_textbook import iter_pdf_content
+from pdfFigureExtract import process_pdf_with_extra_large_margins
+from pdf_pages import PageCache
+from stage_cache import default_cache
+from validate_elements import validate_store
+
+class StageTimer:
+    """Times each pipeline stage (also recorded as a pipeline.<stage> span) and prints a summary"""
+
+    def __init__(self):
+        self.timings = []
+
+    @contextmanager
+    def stage(self, name):
+        print(f"\n=== {name} ===")
+        start = time.perf_counter()
+        try:
+            with metrics.span(f"pipeline.{name}"):
+                yield
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def report(self):
+        total = sum(seconds for _, seconds in self.timings)
+        print(f"\n{'stage':<12} {'seconds':>9} {'share':>7}")
+        for name, seconds in self.timings:
+            print(f"{name:<12} {seconds:>9.2f} {seconds / total if total else 0:>7.1%}")
+        print(f"{'total':<12} {total:>9.2f}")
+
+def write_checkpoint(work_dir, name, data):
+    path = os.path.join(work_dir, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    metrics.incr('bytes_written', os.path.getsize(path))
+
+def run_pipeline(pdf_path, output_file="textbook_video.mp4", work_dir=".", checkpoint=False, workers=1,
+                 scene_concurrency=8, model="gpt-4o", base_url=None, equations=True, cache=None, full_scan=False):
+    """Run every stage in one process: the PDF is opened once and stage outputs are handed over in memory.
+    checkpoint=True also writes each stage's JSON (parsed_elements.json, ... complete_scenes.json) to work_dir.
+    full_scan=True runs the figure and equation detectors on every page instead of the indexed ones.
+    Returns the [(stage, seconds)] timings"""
+    cache = cache or default_cache()
+    figures_dir = os.path.join(work_dir, "extracted_figures_extra_large_margin")
+    equations_dir = os.path.join(work_dir, "extracted_equations")
+    os.makedirs(figures_dir, exist_ok=True)
+    os.makedirs(equations_dir, exist_ok=True)
+
+    doc = fitz.open(pdf_path)
+    # The CV stages render from the open document instead of reopening the PDF. They share no renders
+    # (figures use zoom 1, equations render clips or zoom 3), and figure workers open their own copy
+    page_cache = PageCache(doc)
+    timer = StageTimer()
+
+    with timer.stage('parse'):
+        elements = list(iter_pdf_content(doc, cache=cache, workers=workers))
+        metrics.incr('parse.elements', len(elements))
+        print(f"Parsed {len(elements)} elements from PDF")
+        if checkpoint:
+            write_checkpoint(work_dir, 'parsed_elements.json', elements)
+        # Scene text gets the parsed elements, like the standalone script: validation keys figures by
+        # 0-based file pages and association drops equations, which would hide captions from ContextIndex
+        store = ElementStore(elements)
+
+    with timer.stage('index'):
+        # One classification pass picks the pages both CV stages analyze
+        figure_pages = equation_pages = None
+        if not full_scan:
+            index = PageIndex(doc)
+            figure_pages, equation_pages = index.figure_pages, index.equation_pages
+            print(f"{len(figure_pages)} of {len(index)} pages flagged for figures, {len(equation_pages)} for equations")
+
+    with timer.stage('figures'):
+        figure_files = process_pdf_with_extra_large_margins(pdf_path, figures_dir, page_cache=page_cache,
+                                                            workers=workers, cache=cache, pages=figure_pages,
+                                                            full_scan=full_scan)
+        print(f"Extracted {len(figure_files)} figures")
+
+    if equations:
+        with timer.stage('equations'):
+            equation_files = process_pdf_for_equations(pdf_path, equations_dir, page_cache=page_cache, cache=cache,
+                                                       pages=equation_pages, full_scan=full_scan)
+            print(f"Extracted {len(equation_files)} equations")
+    page_cache.clear()
+
+    with timer.stage('associate'):
+        validated = associate_store(validate_store(store, figures_dir, equations_dir))
+        print(f"Validated {len(validated)} elements")
+        if checkpoint:
+            write_checkpoint(work_dir, 'validated_elements.json', list(validated))
+
+    with timer.stage('scenes'):
+        scenes = create_initial_scenes(figures_dir)
+        print(f"Created {len(scenes)} initial scenes")
+        if checkpoint:
+            save_scenes(scenes, os.path.join(work_dir, 'initial_scenes.json'))
+
+    with timer.stage('text'):
+        output_path = os.path.join(work_dir, 'complete_scenes.json') if checkpoint else None
+        scenes = fill_scene_text(pdf_path, scenes, output_path, model=model, cache=cache,
+                                 concurrency=scene_concurrency, base_url=base_url, elements=store, doc=doc)
+
+    with timer.stage('video'):
+        asyncio.run(create_video(scenes, output_file, cache=cache, workers=workers,
+                                 scene_concurrency=scene_concurrency))
+        print(f"Video successfully created: {output_file}")
+
+    doc.close()
+    timer.report()
+    return timer.timings
+
+def main(argv=None):
+    # Read API keys and settings from .env here rather than on import, before they become argument defaults
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Turn a textbook PDF into a narrated video in one run")
+    parser.add_argument('pdf', nargs='?', default="macro.pdf")
+    parser.add_argument('--output', default="textbook_video.mp4")
+    parser.add_argument('--work-dir', default=".", help="where extracted images and checkpoints go")
+    parser.add_argument('--checkpoint', action='store_true', help="also write each stage's JSON to the work dir")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--scene-concurrency', type=int, default=int(os.getenv("SCENE_CONCURRENCY", "8")))
+    parser.add_argument('--model', default="gpt-4o")
+    parser.add_argument('--base-url', help="OpenAI-compatible endpoint, e.g. a local stand-in")
+    parser.add_argument('--no-equations', action='store_true', help="skip equation extraction")
+    parser.add_argument('--full-scan', action='store_true', help="analyze every page, not just the indexed ones")
+    args = parser.parse_args(argv)
+
+    run_pipeline(args.pdf, args.output, args.work_dir, args.checkpoint, args.workers, args.scene_concurrency,
+                 args.model, args.base_url, equations=not args.no_equations, full_scan=args.full_scan)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
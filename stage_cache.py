@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+
+CACHE_ROOT = os.getenv("TEXTBOOK_CACHE_DIR", ".cache")
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Eviction trims to this share of max_bytes, so a full cache isn't rescanned on every write
+EVICT_TO = 0.8
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_json(value):
+    return hash_bytes(json.dumps(value, sort_keys=True, default=str).encode())
+
+XREF_PATTERN = re.compile(r'(\d+) 0 R')
+
+def referenced_xrefs(doc, xref, key):
+    """xrefs listed in the dict or array under key (e.g. 'Resources/XObject'), or the stream it points to"""
+    kind, value = doc.xref_get_key(xref, key)
+    if kind == 'xref':
+        ref = int(value.split()[0])
+        if doc.xref_is_stream(ref):
+            return [ref]
+        value = doc.xref_object(ref, compressed=True)
+    elif kind not in ('dict', 'array'):
+        return []
+    return [int(ref) for ref in XREF_PATTERN.findall(value)]
+
+def hash_xobjects(doc, xrefs, digest, seen):
+    """Hash XObject dictionaries and streams, following the XObjects each Form XObject draws in turn"""
+    stack = list(xrefs)
+    while stack:
+        xref = stack.pop()
+        if xref in seen:
+            continue
+        seen.add(xref)
+        digest.update(doc.xref_object(xref, compressed=True).encode())
+        digest.update(doc.xref_stream_raw(xref) or b'')
+        stack.extend(referenced_xrefs(doc, xref, 'Resources/XObject'))
+
+def page_content_hash(doc, page_num):
+    """Hash everything that changes what a page shows: content stream, geometry, images, fonts,
+    Form XObjects (e.g. pages placed with show_pdf_page) and annotation appearances"""
+    page = doc.load_page(page_num)
+    digest = hashlib.sha256()
+    digest.update(page.read_contents())
+    digest.update(repr((tuple(page.rect), page.rotation)).encode())
+    for image in page.get_images(full=True):
+        digest.update(doc.xref_stream_raw(image[0]) or b'')
+    for font in page.get_fonts(full=True):
+        digest.update(repr(font[1:]).encode())
+    seen = set()
+    hash_xobjects(doc, [xobject[0] for xobject in page.get_xobjects()], digest, seen)
+    for annot_xref in referenced_xrefs(doc, page.xref, 'Annots'):
+        digest.update(doc.xref_object(annot_xref, compressed=True).encode())
+        hash_xobjects(doc, referenced_xrefs(doc, annot_xref, 'AP/N'), digest, seen)
+    return digest.hexdigest()
+
+def make_key(stage, params=None, inputs=()):
+    """Cache key from the stage name, its parameters and the hashes of its upstream inputs"""
+    return hash_json({'stage': stage, 'params': params or {}, 'inputs': list(inputs)})
+
+class StageCache:
+    """Content-addressed artifact store on local disk with LRU size eviction"""
+
+    def __init__(self, cache_dir=os.path.join(CACHE_ROOT, "stages"), max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._size = None  # Total bytes on disk, scanned lazily
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get_file(self, key):
+        """Return the path of a cached artifact, or None on a miss"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # Mark as recently used
+        return path
+
+    def put_file(self, key, source_path):
+        """Copy a file into the cache and return the cached path"""
+        return self._commit(key, lambda tmp_path: shutil.copyfile(source_path, tmp_path))
+
+    def get_bytes(self, key):
+        path = self.get_file(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put_bytes(self, key, data):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        return self._commit(key, write)
+
+    def get_json(self, key):
+        data = self.get_bytes(key)
+        return None if data is None else json.loads(data)
+
+    def put_json(self, key, value):
+        return self.put_bytes(key, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def _commit(self, key, write):
+        # Write to a temp file and rename so concurrent workers never read a partial entry
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+        self._record_write(os.path.getsize(path))
+        return path
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                # Skip temp files, another process is about to rename them into place
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _record_write(self, n_bytes):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += n_bytes
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is down to EVICT_TO of max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TO
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+_default_cache = None
+
+def default_cache():
+    """Shared pipeline cache, or None when disabled with TEXTBOOK_CACHE=0"""
+    global _default_cache
+    if os.getenv("TEXTBOOK_CACHE", "1") == "0":
+        return None
+    if _default_cache is None:
+        _default_cache = StageCache()
+    return _default_cache
+
+def cached_page_outputs(cache, key, output_directory, produce):
+    """Restore a page's output files from the cache, or run produce() and cache what it wrote.
+    produce() returns (file_paths, extra) where extra is any JSON-serializable detail"""
+    if cache is not None:
+        manifest = cache.get_json(key)
+        if manifest is not None:
+            paths = []
+            for name, blob_key in manifest['files']:
+                data = cache.get_bytes(blob_key)
+                if data is None:  # Blob was evicted, recompute the page
+                    break
+                path = os.path.join(output_directory, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                paths.append(path)
+            else:
+                return paths, manifest['extra']
+
+    paths, extra = produce()
+    if cache is not None:
+        files = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            blob_key = hash_bytes(data)
+            cache.put_bytes(blob_key, data)
+            files.append([os.path.basename(path), blob_key])
+        cache.put_json(key, {'files': files, 'extra': extra})
+    return paths, extra
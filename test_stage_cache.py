@@ -0,0 +1,47 @@
+import fitz
+from stage_cache import StageCache, hash_bytes, page_content_hash
+
+# Run with: python -m pytest test_stage_cache.py
+
+def placed_page_book(caption):
+    """One page that draws another PDF's page through a Form XObject, as show_pdf_page does"""
+    source = fitz.open()
+    source.new_page().insert_text((72, 72), caption)
+    doc = fitz.open()
+    doc.new_page().show_pdf_page(fitz.Rect(0, 0, 595, 842), source, 0)
+    return doc
+
+def test_page_hash_covers_form_xobjects():
+    original = placed_page_book("Figure 1 Original caption")
+    assert page_content_hash(original, 0) == page_content_hash(placed_page_book("Figure 1 Original caption"), 0)
+    assert page_content_hash(original, 0) != page_content_hash(placed_page_book("Figure 1 Edited caption!!"), 0)
+
+def test_page_hash_covers_annotation_appearance():
+    doc = fitz.open()
+    doc.new_page()
+    before = page_content_hash(doc, 0)
+    annot = doc[0].add_freetext_annot(fitz.Rect(100, 100, 300, 150), "Figure 1 note")
+    after = page_content_hash(doc, 0)
+    annot.set_info(content="Figure 1 edited note")
+    annot.update()
+    assert len({before, after, page_content_hash(doc, 0)}) == 3
+
+def test_full_cache_is_not_rescanned_on_every_write(tmp_path, monkeypatch):
+    cache = StageCache(str(tmp_path), max_bytes=100 * 1024)
+    scans = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, '_entries', lambda: scans.append(1) or entries())
+    for i in range(1000):
+        cache.put_bytes(hash_bytes(str(i).encode()), b'x' * 1024)
+    # Each eviction frees a fifth of the cache, about 20 writes
+    assert len(scans) < 60
+    assert sum(size for _, size, _ in entries()) <= cache.max_bytes
+
+def test_eviction_keeps_in_flight_temp_files(tmp_path):
+    cache = StageCache(str(tmp_path), max_bytes=4 * 1024)
+    tmp_file = tmp_path / "ab" / "ab12.999.tmp"
+    tmp_file.parent.mkdir()
+    tmp_file.write_bytes(b'x' * 8 * 1024)
+    cache.put_bytes(hash_bytes(b'entry'), b'x' * 1024)
+    cache.evict()
+    assert tmp_file.exists()
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import re
+import threading
+from contextlib import asynccontextmanager, contextmanager
+import fitz
+import numpy as np
+from aiohttp import web
+import create_video
+from fill_scene_text import fill_scene_text
+
+# Run with: python -m pytest test_stand_ins.py
+# The stand-ins replace the OpenAI and Deepgram endpoints on localhost, nothing goes over the network
+
+@contextmanager
+def stand_in(routes):
+    """Serve an aiohttp app from a background thread, yields its base URL"""
+    app = web.Application()
+    app.add_routes(routes)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        yield f"http://{host}:{port}"
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+class InFlight:
+    """Counts requests the stand-in is handling at once"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    @asynccontextmanager
+    async def track(self):
+        self.current += 1
+        self.peak = max(self.peak, self.current)
+        try:
+            yield
+        finally:
+            self.current -= 1
+
+def write_pdf(path, pages=1):
+    doc = fitz.open()
+    for _ in range(pages):
+        doc.new_page()
+    doc.save(path)
+    return str(path)
+
+def scene_reply(content):
+    return "```json\n" + json.dumps({'pre_text': content, 'scene_text': '', 'post_text': ''}) + "\n```"
+
+def test_scene_text_keeps_order_and_concurrency_limit(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("TEXTBOOK_CACHE", "0")
+    monkeypatch.chdir(tmp_path)
+    in_flight = InFlight()
+
+    async def chat(request):
+        body = await request.json()
+        title = re.search(r'associated with (Figure \d+)', body['messages'][-1]['content']).group(1)
+        async with in_flight.track():
+            # Later scenes answer first, so the output order can't come from completion order
+            await asyncio.sleep(0.02 * (10 - int(title.split()[1])))
+        return web.json_response({
+            'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': scene_reply(title)}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15},
+        })
+
+    scenes = [{'title': f"Figure {i}", 'page_number': 0} for i in range(8)]
+    elements = [{'type': 'paragraph', 'page_number': 1, 'y_position': 10, 'bottom_y': 20, 'text': "Body text."}]
+    with stand_in([web.post('/v1/chat/completions', chat)]) as url:
+        processed = fill_scene_text(write_pdf(tmp_path / "book.pdf"), scenes, None, concurrency=3,
+                                    base_url=f"{url}/v1", elements=elements)
+
+    assert [scene['text'] for scene in processed] == [f"Figure {i}" for i in range(8)]
+    assert in_flight.peak == 3
+
+def test_tts_keeps_chunk_order_and_concurrency_limit(monkeypatch):
+    monkeypatch.setenv("DEEPGRAM_API_KEY", "test-key")
+    monkeypatch.setenv("TEXTBOOK_CACHE", "0")
+    monkeypatch.setattr(create_video, 'TTS_CONCURRENCY', 2)
+    in_flight = InFlight()
+    connections = set()
+
+    async def speak(request):
+        assert request.headers['Authorization'] == "Token test-key"
+        assert request.query['model'] == create_video.VOICE_MODEL
+        connections.add(request.transport.get_extra_info('peername'))
+        # Each chunk answers with samples set to the number of its first sentence, the first chunk answers last
+        first = int(re.search(r'Sentence (\d+)', (await request.json())['text']).group(1))
+        async with in_flight.track():
+            await asyncio.sleep(0.2 if first == 0 else 0.02)
+        return web.Response(body=np.full(100, first, dtype='<i2').tobytes(), content_type='audio/l16')
+
+    text = ' '.join(f"Sentence {n} of the narration for this scene." for n in range(300))
+    chunks = create_video.split_into_chunks(text, balanced=True)
+    expected = [int(re.search(r'Sentence (\d+)', chunk).group(1)) for chunk in chunks]
+
+    async def narrate():
+        try:
+            return await create_video.generate_audio(text, "scene")
+        finally:
+            await create_video.close_tts_client()
+
+    with stand_in([web.post('/v1/speak', speak)]) as url:
+        monkeypatch.setenv("DEEPGRAM_URL", url)
+        samples = asyncio.run(narrate())
+
+    assert len(chunks) > 2
+    assert samples[::100].tolist() == expected
+    assert in_flight.peak == 2
+    # Every request went through the pooled client's connections
+    assert len(connections) <= 2
@@ -1,42 +1,69 @@
 from pathlib import Path
 import json
-def match_visual_elements(elements, figures_dir, equations_dir):
-    """Match and validate visual elements with extracted files"""
-    validated_elements = []
-    
-    # Get lists of extracted files
-    figure_files = Path(figures_dir).glob('*.png')
-    # equation_files = Path(equations_dir).glob('*.png')
-    
+import numpy as np
+from element_store import FIGURE_TABLE, ElementStore
+
+def file_index(directory):
+    """Map every name part after the prefix (e.g. 'page3') to the first file containing it, in glob order"""
     # Create lookup dictionaries
-    figure_lookup = {tuple(f.stem.split('_')[1:]): str(f) for f in figure_files}
-    # equation_lookup = {tuple(f.stem.split('_')[1:]): str(f) for f in equation_files}
+    lookup = {tuple(f.stem.split('_')[1:]): str(f) for f in Path(directory).glob('*.png')}
+    index = {}
+    for parts, path in lookup.items():
+        for part in parts:
+            index.setdefault(part, path)
+    return index
+
+def iter_visual_elements(elements, figures_dir, equations_dir):
+    """Lazily match and validate visual elements with extracted files, accepts any element iterable"""
+    # One dict lookup per element instead of scanning every file
+    figure_index = file_index(figures_dir)
+    # equation_index = file_index(equations_dir)
     
     for element in elements:
         if element['type'] == 'figure_table':
             # Try to find matching figure file
-            page_key = f"page{element['page_number']}"
-            matching_files = [v for k, v in figure_lookup.items() 
-                            if page_key in k]
+            matching_file = figure_index.get(f"page{element['page_number']}")
             
-            if matching_files:
-                element['file_path'] = matching_files[0]
-                validated_elements.append(element)
+            if matching_file:
+                element['file_path'] = matching_file
+                yield element
                 
         # elif element['type'] == 'equation':
         #     # Try to find matching equation file
-        #     page_key = f"page{element['page_number']}"
-        #     matching_files = [v for k, v in equation_lookup.items() 
-        #                     if page_key in k]
+        #     matching_file = equation_index.get(f"page{element['page_number']}")
             
-        #     if matching_files:
-        #         element['file_path'] = matching_files[0]
-        #         validated_elements.append(element)
+        #     if matching_file:
+        #         element['file_path'] = matching_file
+        #         yield element
                 
         else:  # Paragraphs are always kept
-            validated_elements.append(element)
+            yield element
+
+def validate_store(store, figures_dir, equations_dir):
+    """ElementStore version of iter_visual_elements: fills figure file paths by page and drops unmatched figures.
+    Returns a new store, the given one is left unchanged"""
+    figure_index = file_index(figures_dir)
+    keep = np.ones(len(store), dtype=bool)
+    file_paths = list(store.file_paths)
+    for row in np.flatnonzero(store.types == FIGURE_TABLE).tolist():
+        matching_file = figure_index.get(f"page{store.pages[row]}")
+        if matching_file:
+            file_paths[row] = matching_file
+        else:
+            keep[row] = False
+    rows = np.flatnonzero(keep)
+    validated = store.take(rows)
+    validated.file_paths = [file_paths[row] for row in rows.tolist()]
+    return validated
+
+def match_visual_elements(elements, figures_dir, equations_dir):
+    """Match and validate visual elements with extracted files. Accepts a list of elements or an ElementStore"""
+    if isinstance(elements, ElementStore):
+        validated_elements = validate_store(elements, figures_dir, equations_dir)
+    else:
+        validated_elements = list(iter_visual_elements(elements, figures_dir, equations_dir))
     
     print(f"Validated {len(validated_elements)} elements")
-    json.dump(validated_elements, open('validated_elements.json', 'w'), indent=4)
+    json.dump(list(validated_elements), open('validated_elements.json', 'w'), indent=4)
 
-    return validated_elements 
\ No newline at end of file
+    return validated_elements 